@@ -4,32 +4,379 @@ from matplotlib import pyplot as plt
 import decimal
 
 """
-Compute the 4 elements that serve as basis for every other metric, which are:
+Counts of a classification, built in one pass over the (true, predicted) pairs, from which every metric below is derived without reading the data again.
+   matrix - the counts as a (K, K) int64 array, matrix[i, j] being the number of samples of true label labels[i] predicted as labels[j]
+   labels - the K labels, in the order of the rows and columns of matrix
+For each label, taken in turn as the positive class, the 4 elements that serve as basis for every other metric are:
    true positives (Tp) - positive samples that are predicted as positives
    true negatives (Tn) - negative samples that are predicted as negatives
    false positives (Fp) - negative samples that are predicted as positives
    false negatives (Fn) - positive samples that are predicted as negatives
+The rates (precision, recall...) are arrays holding one value per label. average gives their macro, micro or weighted average over the labels.
+With labels [true_val, false_val], the first values are the ones of the binary metrics.
+The counts can also be accumulated over chunks of the data with update, and the matrices of several workers added together with merge (see the accumulators below).
+matrix can also be a stack of matrices of shape (B, K, K), e.g. the bootstrap replicates of bootstrap_confidence_intervals, the metrics then having an extra first axis of length B.
 """
-def compute_basics(true, predicted, true_val = 1, false_val = 0):
+class ConfusionMatrix:
+
+    # The rates as functions of the 4 basic elements, which can be arrays of one value per label
+    rates = {"false_positive_rate": lambda Tp, Tn, Fp, Fn: Fp/(Fp+Tn),
+             "false_negative_rate": lambda Tp, Tn, Fp, Fn: Fn/(Tp+Fn),
+             "true_negative_rate": lambda Tp, Tn, Fp, Fn: Tn/(Fp+Tn),
+             "negative_predicted_value": lambda Tp, Tn, Fp, Fn: Tn/(Fn+Tn),
+             "false_discovery_rate": lambda Tp, Tn, Fp, Fn: Fp/(Tp+Fp),
+             "recall": lambda Tp, Tn, Fp, Fn: Tp/(Tp+Fn),
+             "precision": lambda Tp, Tn, Fp, Fn: Tp/(Tp+Fp),
+             "f1_score": lambda Tp, Tn, Fp, Fn: (2*Tp)/(2*Tp+Fp+Fn)}
+
+    def __init__(self, matrix, labels):
+        self.matrix = matrix
+        self.labels = labels
+
+    """
+    Builds the confusion matrix of true and predicted, which must be 1d arrays of the same length. Samples whose true or predicted label isn't in labels aren't counted.
+    Without labels, the labels are all the values found in true and predicted, sorted.
+    Integer labels are turned into bin indices by subtracting the smallest one, other labels by a binary search in the sorted labels. The pairs are then counted with a single np.bincount.
+    Labels given as floats holding integer values (e.g. true_val=1.0) are used as integers with integer data, other labels go through the binary search.
+    """
+    @classmethod
+    def from_predictions(cls, true, predicted, labels=None):
+        if true.dtype==bool:
+            true = true.view(np.int8)
+        if predicted.dtype==bool:
+            predicted = predicted.view(np.int8)
+        if labels is not None:
+            labels = np.asarray(labels)
+        integer_labels = labels is None or labels.dtype==bool or np.issubdtype(labels.dtype, np.integer) or (np.issubdtype(labels.dtype, np.floating) and np.array_equal(labels, np.round(labels)))
+        if np.issubdtype(true.dtype, np.integer) and np.issubdtype(predicted.dtype, np.integer) and integer_labels and true.shape[0]>0:
+            low = int(min(true.min(), predicted.min()))
+            size = int(max(true.max(), predicted.max()))-low+1
+            if size<=1024:
+                # The offsets are computed in np.intp, as they would overflow the dtype of the data (e.g. 127-(-128) in int8)
+                pairs = (true.astype(np.intp)-low)*size
+                pairs += predicted.astype(np.intp)-low
+                counts = np.bincount(pairs, minlength=size*size).reshape(size, size)
+                if labels is None:
+                    present = (counts.sum(axis=0)+counts.sum(axis=1))>0
+                    return cls(counts[np.ix_(present, present)], np.nonzero(present)[0]+low)
+                indices = labels.astype(np.intp)-low
+                inside = (indices>=0) & (indices<size)
+                matrix = np.zeros((labels.shape[0], labels.shape[0]), dtype=np.int64)
+                matrix[np.ix_(inside, inside)] = counts[np.ix_(indices[inside], indices[inside])]
+                return cls(matrix, labels)
+        if labels is None:
+            labels = np.unique(np.concatenate((true, predicted)))
+        labels = np.asarray(labels)
+        n_labels = labels.shape[0]
+        order = np.argsort(labels)
+        # Unknown labels get the index n_labels, whose row and column are dropped
+        indices = np.append(order, n_labels)
+        true_codes = np.searchsorted(labels[order], true)
+        true_codes[true_codes==n_labels] = 0
+        true_codes = indices[np.where(labels[order][true_codes]==true, true_codes, n_labels)]
+        predicted_codes = np.searchsorted(labels[order], predicted)
+        predicted_codes[predicted_codes==n_labels] = 0
+        predicted_codes = indices[np.where(labels[order][predicted_codes]==predicted, predicted_codes, n_labels)]
+        counts = np.bincount(true_codes*(n_labels+1)+predicted_codes, minlength=(n_labels+1)**2).reshape(n_labels+1, n_labels+1)
+        return cls(counts[:n_labels, :n_labels], labels)
+
+    """
+    Returns an empty confusion matrix for the given labels, to be filled with update.
+    """
+    @classmethod
+    def empty(cls, labels):
+        labels = np.asarray(labels)
+        return cls(np.zeros((labels.shape[0], labels.shape[0]), dtype=np.int64), labels)
+
+    """
+    Adds the counts of a chunk of true and predicted labels. Labels that aren't in labels aren't counted.
+    """
+    def update(self, true, predicted):
+        if true.shape[0]!=predicted.shape[0]:
+            print(f"True and predicted must have same length but found {true.shape[0]} and {predicted.shape[0]}")
+            return
+        self.matrix += ConfusionMatrix.from_predictions(true, predicted, self.labels).matrix
+
+    """
+    Adds the counts of another confusion matrix with the same labels, e.g. built by another worker on another part of the data.
+    """
+    def merge(self, other):
+        if not np.array_equal(self.labels, other.labels):
+            print(f"Confusion matrices must have the same labels but found {self.labels} and {other.labels}")
+            return
+        self.matrix += other.matrix
+
+    """
+    Returns the confusion matrix itself, whose properties are the metrics, as the result of the accumulators below.
+    """
+    def result(self):
+        return self
+
+    @property
+    def total(self):
+        return self.matrix.sum(axis=(-2, -1))
+
+    @property
+    def support(self):
+        return self.matrix.sum(axis=-1)
+
+    @property
+    def true_positives(self):
+        return np.diagonal(self.matrix, axis1=-2, axis2=-1).copy()
+
+    @property
+    def false_positives(self):
+        return self.matrix.sum(axis=-2)-np.diagonal(self.matrix, axis1=-2, axis2=-1)
+
+    @property
+    def false_negatives(self):
+        return self.matrix.sum(axis=-1)-np.diagonal(self.matrix, axis1=-2, axis2=-1)
+
+    @property
+    def true_negatives(self):
+        return self.total[..., np.newaxis]-self.matrix.sum(axis=-2)-self.matrix.sum(axis=-1)+np.diagonal(self.matrix, axis1=-2, axis2=-1)
+
+    """
+    Returns Tp, Tn, Fp, Fn for the first label taken as the positive class, as in compute_basics.
+    """
+    @property
+    def basics(self):
+        return int(self.true_positives[0]), int(self.true_negatives[0]), int(self.false_positives[0]), int(self.false_negatives[0])
+
+    """
+    Returns the given rate (a key of rates) for each label, or averaged over the labels:
+       macro - the mean of the rates of the labels
+       weighted - the mean of the rates of the labels weighted by their support (their number of true samples)
+       micro - the rate of the sums of the basic elements over the labels. For the recall, the precision and the f1-score of a multi-class problem, this is the accuracy
+    Rates whose denominator is 0 are nan.
+    """
+    def rate(self, name, average=None):
+        return self.derive(self.rates[name], average)
+
+    """
+    Applies formula, a function of Tp, Tn, Fp, Fn, to the basic elements of each label and averages the results as in rate.
+    """
+    def derive(self, formula, average=None):
+        with np.errstate(divide="ignore", invalid="ignore"):
+            if average=="micro":
+                return formula(self.true_positives.sum(axis=-1), self.true_negatives.sum(axis=-1), self.false_positives.sum(axis=-1), self.false_negatives.sum(axis=-1))
+            rates = formula(self.true_positives, self.true_negatives, self.false_positives, self.false_negatives)
+        if average==None:
+            return rates
+        if average=="macro":
+            return np.mean(rates, axis=-1)
+        if average=="weighted":
+            return np.sum(rates*self.support, axis=-1)/self.total
+        print(f"Unknown average {average}, must be macro, micro or weighted")
+        return
+
+    @property
+    def false_positive_rate(self):
+        return self.rate("false_positive_rate")
+
+    @property
+    def false_negative_rate(self):
+        return self.rate("false_negative_rate")
+
+    @property
+    def true_negative_rate(self):
+        return self.rate("true_negative_rate")
+
+    @property
+    def negative_predicted_value(self):
+        return self.rate("negative_predicted_value")
+
+    @property
+    def false_discovery_rate(self):
+        return self.rate("false_discovery_rate")
+
+    @property
+    def recall(self):
+        return self.rate("recall")
+
+    @property
+    def precision(self):
+        return self.rate("precision")
+
+    @property
+    def f1_score(self):
+        return self.rate("f1_score")
+
+    """
+    Returns the f_beta score of each label, or averaged over the labels as in rate.
+    """
+    def fBeta_score(self, beta, average=None):
+        return self.derive(lambda Tp, Tn, Fp, Fn: (Tp*(1+beta**2))/((Tp*(1+beta**2))+((beta**2)*Fn)+Fp), average)
+
+    @property
+    def accuracy(self):
+        return np.trace(self.matrix, axis1=-2, axis2=-1)/self.total
+
+    """
+    Kappa statistic over all labels: expected_accuracy is the probability that a random classifier predicting each label as often as this one agrees with the truth.
+    """
+    @property
+    def kappa_statistics(self):
+        observed_accuracy = self.accuracy
+        expected_accuracy = np.sum(self.matrix.sum(axis=-1)*self.matrix.sum(axis=-2), axis=-1)/self.total**2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return (observed_accuracy-expected_accuracy)/(1 - expected_accuracy)
+
+    """
+    Matthews correlation coefficient over all labels, which is the binary one for 2 labels.
+    """
+    @property
+    def matthews_correlation_coefficient(self):
+        true_counts = self.matrix.sum(axis=-1).astype(np.float64)
+        predicted_counts = self.matrix.sum(axis=-2).astype(np.float64)
+        total = self.total.astype(np.float64)
+        numerator = np.trace(self.matrix, axis1=-2, axis2=-1)*total-np.sum(true_counts*predicted_counts, axis=-1)
+        denominator = np.sqrt((total**2-np.sum(predicted_counts**2, axis=-1))*(total**2-np.sum(true_counts**2, axis=-1)))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return numerator/denominator
+
+"""
+Accumulators of the metrics over a stream of chunks, for data that doesn't fit in memory or is scored by several workers.
+Each one has the same interface as ConfusionMatrix.empty(labels):
+   update(true, predicted) - adds a chunk of true labels and predictions
+   merge(other) - adds the state of another accumulator of the same kind, e.g. built by another process on another part of the data
+   result() - returns the metric over everything added so far
+Their state is a few sums or histograms, so they take the same memory whatever the number of samples, and can be sent between processes.
+"""
+
+"""
+Accumulates the log loss of probabilities predicted for binary true labels in {0, 1}, optionally weighted, as compute_log_loss.
+"""
+class LogLossAccumulator:
+
+    def __init__(self, eps=1e-15):
+        self.eps = eps
+        self.loss = 0.
+        self.weight = 0.
+
+    def update(self, true, predicted, sample_weight=None):
+        if true.shape[0]!=predicted.shape[0]:
+            print(f"True and predicted must have same length but found {true.shape[0]} and {predicted.shape[0]}")
+            return
+        loss, weight = log_loss_sums(true, predicted, self.eps, sample_weight)
+        self.loss += loss
+        self.weight += weight
+
+    def merge(self, other):
+        self.loss += other.loss
+        self.weight += other.weight
+
+    def result(self):
+        return weighted_mean(self.loss, self.weight)
+
+"""
+Accumulates the brier score of probabilities predicted for binary true labels in {0, 1}, optionally weighted, as compute_brier_score.
+"""
+class BrierScoreAccumulator:
+
+    def __init__(self):
+        self.squared_error = 0.
+        self.weight = 0.
+
+    def update(self, true, predicted, sample_weight=None):
+        if true.shape[0]!=predicted.shape[0]:
+            print(f"True and predicted must have same length but found {true.shape[0]} and {predicted.shape[0]}")
+            return
+        squared_error, weight = brier_score_sums(true, predicted, sample_weight)
+        self.squared_error += squared_error
+        self.weight += weight
+
+    def merge(self, other):
+        self.squared_error += other.squared_error
+        self.weight += other.weight
+
+    def result(self):
+        return weighted_mean(self.squared_error, self.weight)
+
+"""
+Accumulates the histograms of the scores of the positive and negative samples over n_bins equal bins between low and high, from which the ROC curve and its area are computed.
+Scores outside of [low, high] are counted in the first or last bin. Unlike compute_auc_roc, two samples in the same bin count as a tie, so the area is off by at most half the proportion of (positive, negative) pairs sharing a bin.
+The default range suits probabilities. For decision values (e.g. of SVM.predict_kernel), give a range covering them.
+"""
+class BinnedAUCAccumulator:
+
+    def __init__(self, n_bins=10000, low=0., high=1., true_val=1, false_val=0):
+        self.n_bins = n_bins
+        self.low = low
+        self.high = high
+        self.true_val = true_val
+        self.false_val = false_val
+        self.positives = np.zeros(n_bins, dtype=np.int64)
+        self.negatives = np.zeros(n_bins, dtype=np.int64)
+
+    def update(self, true, predicted):
+        if true.shape[0]!=predicted.shape[0]:
+            print(f"True and predicted must have same length but found {true.shape[0]} and {predicted.shape[0]}")
+            return
+        bins = np.clip(((predicted-self.low)*(self.n_bins/(self.high-self.low))).astype(np.intp), 0, self.n_bins-1)
+        self.positives += np.bincount(bins[true==self.true_val], minlength=self.n_bins)
+        self.negatives += np.bincount(bins[true==self.false_val], minlength=self.n_bins)
+
+    def merge(self, other):
+        if (self.n_bins, self.low, self.high)!=(other.n_bins, other.low, other.high):
+            print("Binned AUC accumulators must have the same bins")
+            return
+        self.positives += other.positives
+        self.negatives += other.negatives
+
+    """
+    Returns the false positive rates, true positive rates and thresholds (the lower edges of the bins) of the ROC curve, as compute_roc_curve.
+    """
+    def roc_curve(self):
+        thresholds = self.low+np.arange(self.n_bins-1, -1, -1)*((self.high-self.low)/self.n_bins)
+        Tp = np.cumsum(self.positives[::-1])
+        Fp = np.cumsum(self.negatives[::-1])
+        FPR = np.concatenate(([0.], Fp/Fp[-1]))
+        TPR = np.concatenate(([0.], Tp/Tp[-1]))
+        return FPR, TPR, np.concatenate(([np.inf], thresholds))
+
+    def result(self):
+        below = np.cumsum(self.negatives)-self.negatives
+        return np.sum(self.positives*(below+0.5*self.negatives))/(np.sum(self.positives)*np.sum(self.negatives))
+
+"""
+Updates each accumulator with every (true, predicted) chunk given by chunks, e.g. a generator reading the predictions of a model chunk by chunk, and returns their results.
+"""
+def accumulate_metrics(chunks, accumulators):
+    for true, predicted in chunks:
+        for accumulator in accumulators:
+            accumulator.update(true, predicted)
+    return [accumulator.result() for accumulator in accumulators]
+
+"""
+Returns the binary confusion matrix of true and predicted, the first label being the positive class. True and predicted must be 1d arrays
+A report calling several metrics should build it once and read the metrics from it instead of calling the functions below, which each build it again.
+"""
+def compute_confusion_matrix(true, predicted, true_val = 1, false_val = 0):
     if true.shape[0]!=predicted.shape[0]:
         print(f"True and predicted must have same length but found {true.shape[0]} and {predicted.shape[0]}")
         return
-    added = true+predicted
-    subtracted = true-predicted
-    Tp = np.argwhere(added==2*true_val).shape[0]
-    Tn = np.argwhere(added==2*false_val).shape[0]
-    Fp = np.argwhere(subtracted==false_val-true_val).shape[0]
-    Fn = np.argwhere(subtracted==true_val-false_val).shape[0]
-    return Tp, Tn, Fp, Fn
+    return ConfusionMatrix.from_predictions(true, predicted, labels=[true_val, false_val])
+
+"""
+Compute the 4 elements that serve as basis for every other metric, which are:
+   true positives (Tp) - positive samples that are predicted as positives
+   true negatives (Tn) - negative samples that are predicted as negatives
+   false positives (Fp) - negative samples that are predicted as positives
+   false negatives (Fn) - positive samples that are predicted as negatives
+"""
+def compute_basics(true, predicted, true_val = 1, false_val = 0):
+    confusion = compute_confusion_matrix(true, predicted, true_val, false_val)
+    if confusion is None:
+        return
+    return confusion.basics
 
 """
 Displays the confusion matrix. True and predicted must be 1d arrays
 Gives to option to plot it in a given axis.
 """
 def display_confusion_matrix(true, predicted, true_val = 1, false_val = 0, ax=None):
-    Tp, Tn, Fp, Fn = compute_basics(true, predicted, true_val, false_val)
-    
-    matrix = np.array([[Tp, Fn], [Fp, Tn]])
+    matrix = compute_confusion_matrix(true, predicted, true_val, false_val).matrix
     if ax==None:
         _, ax = plt.subplots()
     colormap = sns.color_palette("Blues", as_cmap=True)
@@ -37,8 +384,8 @@ def display_confusion_matrix(true, predicted, true_val = 1, false_val = 0, ax=No
     ax.set_title("Confusion matrix")
     ax.set_xlabel("Predicted values")
     ax.set_ylabel("True values")
-    ax.xaxis.set_ticklabels(['1','0'])
-    ax.yaxis.set_ticklabels(['1','0'])
+    ax.xaxis.set_ticklabels([str(true_val), str(false_val)])
+    ax.yaxis.set_ticklabels([str(true_val), str(false_val)])
     plt.show()
 
 """
@@ -47,8 +394,7 @@ This is calculated as the number of false positives (Fp) on the number of total
 In other words, it measures, out of all negatives, how many the model has incorrectly identified as positives.
 """
 def compute_false_positive_rate(true, predicted, true_val = 1, false_val = 0):
-    _, Tn, Fp, _ = compute_basics(true, predicted, true_val, false_val)
-    return (Fp/(Fp+Tn))
+    return compute_confusion_matrix(true, predicted, true_val, false_val).false_positive_rate[0]
 
 """
 Returns the false negative rate (a.k.a. type 2 error). True and predicted must be 1d arrays
@@ -56,8 +402,7 @@ This is calculated as the number of false negatives (Fn) on the number of total
 In other words, it measures, out of all positives, how many the model has incorrectly identified as negatives.
 """
 def compute_false_negative_rate(true, predicted, true_val = 1, false_val = 0):
-    Tp, _, _, Fn = compute_basics(true, predicted, true_val, false_val)
-    return (Fn/(Tp+Fn))
+    return compute_confusion_matrix(true, predicted, true_val, false_val).false_negative_rate[0]
 
 """
 Returns the true negative rate (a.k.a. specificity). True and predicted must be 1d arrays
@@ -65,8 +410,7 @@ This is calculated as the number of true negatives (Tn) on the number of total p
 In other words, it measures, out of all negatives, how many the model has correctly identified as negatives.
 """
 def compute_true_negative_rate(true, predicted, true_val = 1, false_val = 0):
-    _, Tn, Fp, _ = compute_basics(true, predicted, true_val, false_val)
-    return (Tn/(Fp+Tn))
+    return compute_confusion_matrix(true, predicted, true_val, false_val).true_negative_rate[0]
 
 """
 Returns the negative predicted value (a.k.a. precision for negative class). True and predicted must be 1d arrays
@@ -74,8 +418,7 @@ This is calculated as the number of true negatives (Tn) on the number of all pre
 In other words, it measures, out of all negative predictions, how many were actually negatives.
 """
 def compute_negative_predicted_value(true, predicted, true_val = 1, false_val = 0):
-    _, Tn, _, Fn = compute_basics(true, predicted, true_val, false_val)
-    return (Tn/(Fn+Tn))
+    return compute_confusion_matrix(true, predicted, true_val, false_val).negative_predicted_value[0]
 
 """
 Returns the false discovery rate. True and predicted must be 1d arrays
@@ -83,8 +426,7 @@ This is calculated as the number of false positives (Fp) on the number of all pr
 In other words, it measures, out of all positive predictions, how many mistakes there are.
 """
 def compute_false_discovery_rate(true, predicted, true_val = 1, false_val = 0):
-    Tp, _, Fp, _ = compute_basics(true, predicted, true_val, false_val)
-    return (Fp/(Tp+Fp))
+    return compute_confusion_matrix(true, predicted, true_val, false_val).false_discovery_rate[0]
 
 """
 Returns the recall (a.k.a. true positive rate, a.k.a. sensitivity). True and predicted must be 1d arrays
@@ -92,8 +434,7 @@ This is calculated as the number of true positives (Tp) on the number of all pos
 In other words, it measures, out of all positives, how many were found by the model.
 """
 def compute_recall(true, predicted, true_val = 1, false_val = 0):
-    Tp, _, _, Fn = compute_basics(true, predicted, true_val, false_val)
-    return (Tp/(Tp+Fn))
+    return compute_confusion_matrix(true, predicted, true_val, false_val).recall[0]
 
 """
 Returns the precision (a.k.a. positive predicted value). True and predicted must be 1d arrays
@@ -101,8 +442,7 @@ This is calculated as the number of true positives (Tp) on the number of all pre
 In other words, it measures, out of all predicted positives, how many actually positives.
 """
 def compute_precision(true, predicted, true_val = 1, false_val = 0):
-    Tp, _, Fp, _ = compute_basics(true, predicted, true_val, false_val)
-    return (Tp/(Tp+Fp))
+    return compute_confusion_matrix(true, predicted, true_val, false_val).precision[0]
 
 """
 Returns the accuracy. True and predicted must be 1d arrays
@@ -110,8 +450,7 @@ This is calculated as the number of true positives (Tp) and true negatives (Tn)
 In other words, it measures, out of all samples, how many correctly classified.
 """
 def compute_accuracy(true, predicted, true_val = 1, false_val = 0):
-    Tp, Tn, Fp, Fn = compute_basics(true, predicted, true_val, false_val)
-    return ((Tp+Tn)/(Tp+Tn+Fp+Fn))
+    return compute_confusion_matrix(true, predicted, true_val, false_val).accuracy
 
 """
 Returns the f1-score. True and predicted must be 1d arrays
@@ -119,16 +458,14 @@ This is calculated as precision times recall on precision added to recall.
 In other words, it is a harmonic mean between precision and recall, giving both the same importance.
 """
 def compute_f1_score(true, predicted, true_val = 1, false_val = 0):
-    Tp, _, Fp, Fn = compute_basics(true, predicted, true_val, false_val)
-    return ((2*Tp)/(2*Tp+Fp+Fn))
+    return compute_confusion_matrix(true, predicted, true_val, false_val).f1_score[0]
 
 """
 Returns the f_beta score. True and predicted must be 1d arrays
 This is a generalization of the f1 score. Here, the more you care about the recall over the precision, the higher beta should be.
 """
 def compute_fBeta_score(true, predicted, beta, true_val = 1, false_val = 0):
-    Tp, _, Fp, Fn = compute_basics(true, predicted, true_val, false_val)
-    return ((Tp*(1+beta^2))/((Tp*(1+beta^2))+((beta^2)*Fn)+Fp))
+    return compute_confusion_matrix(true, predicted, true_val, false_val).fBeta_score(beta)[0]
 
 """
 Returns the kappa statistic. True and predicted must be 1d arrays
@@ -137,16 +474,7 @@ The latter is calculated looking at a percentage of time classifiers agree.
 In other words, the kappa statistics measures how much better the classifier is than a random classifier. 
 """
 def compute_kappa_statistics(true, predicted, true_val = 1, false_val = 0):
-    Tp, Tn, Fp, Fn = compute_basics(true, predicted, true_val, false_val)
-    print(Tp, Tn, Fp, Fn)
-    observed_accuracy = (Tp+Tn)/(Tp+Tn+Fp+Fn)
-    expected_proportion_ground_positive = (Tp+Fn)/(Tp+Tn+Fp+Fn)
-    expected_proportion_classifier_positive = (Tp+Fp)/(Tp+Tn+Fp+Fn)
-    expected_proportion_ground_negative = (Fp+Tn)/(Tp+Tn+Fp+Fn)
-    expected_proportion_classifier_negative = (Fn+Tn)/(Tp+Tn+Fp+Fn)
-    expected_accuracy = (expected_proportion_ground_positive*expected_proportion_classifier_positive)+(expected_proportion_ground_negative*expected_proportion_classifier_negative)
-    print(observed_accuracy, expected_accuracy)
-    return (observed_accuracy-expected_accuracy)/(1 - expected_accuracy)
+    return compute_confusion_matrix(true, predicted, true_val, false_val).kappa_statistics
 
 """
 Returns Matthews correlation coefficient (a.k.a. MCC). True and predicted must be 1d arrays
@@ -155,15 +483,34 @@ It returns a number between -1 and 1, with -1 being total disagreement between p
 O is also regarded as a random prediction
 """
 def compute_matthews_correlation_coefficient(true, predicted, true_val = 1, false_val = 0):
-    Tp, Tn, Fp, Fn = compute_basics(true, predicted, true_val, false_val)
-    numerator = (Tp*Tn)-Fp*Fn
-    denominator = np.sqrt((Tp+Fp)*(Tp+Fn)*(Tn+Fp)*(Tn+Fn))
-    return numerator/denominator
+    return compute_confusion_matrix(true, predicted, true_val, false_val).matthews_correlation_coefficient
+
+"""
+Returns the exact receiver operating characteristic curve as three arrays: the false positive rates, the true positive rates and the thresholds. True and predicted must be 1d arrays
+The samples are sorted once by decreasing predicted score. Lowering the threshold down to each distinct score adds the samples having that score to the predicted positives,
+so the true and false positives at every threshold are cumulative sums over the sorted samples. The first point is (0, 0), for a threshold above every score.
+"""
+def compute_roc_curve(true, predicted, true_val = 1, false_val = 0):
+    if true.shape[0]!=predicted.shape[0]:
+        print(f"True and predicted must have same length but found {true.shape[0]} and {predicted.shape[0]}")
+        return
+    # The order within a group of equal scores doesn't matter as only the counts at the end of each group are kept
+    order = np.argsort(predicted)[::-1]
+    sorted_predicted = predicted[order]
+    sorted_true = true[order]
+    # The last sample of each group of equal scores closes a threshold
+    distinct = np.append(np.nonzero(sorted_predicted[1:]!=sorted_predicted[:-1])[0], sorted_predicted.shape[0]-1)
+    Tp = np.cumsum(sorted_true==true_val)[distinct]
+    Fp = np.cumsum(sorted_true==false_val)[distinct]
+    FPR = np.concatenate(([0.], Fp/Fp[-1]))
+    TPR = np.concatenate(([0.], Tp/Tp[-1]))
+    thresholds = np.concatenate(([np.inf], sorted_predicted[distinct]))
+    return FPR, TPR, thresholds
 
 """
 Displays the receiver operating characteristic curve (a.k.a ROC curve). True and predicted must be 1d arrays
 Roc is usually used to find the prediction boundary and therefore is better when used with continuous values, not with binary values as the other metrics.
-Gives the option to plot it in a given axis with given label. Also, provides the degree of precision of the curve given as the number of points plotted
+Gives the option to plot it in a given axis with given label. The curve is the exact one (see compute_roc_curve), precision being the maximum number of points plotted
 """
 def display_roc_curve(true, predicted, true_val = 1, false_val = 0, ax=None, label="classifier", precision=10000):
     if true.shape[0]!=predicted.shape[0]:
@@ -174,16 +521,11 @@ def display_roc_curve(true, predicted, true_val = 1, false_val = 0, ax=None, lab
         _, ax = plt.subplots()
     baseline = np.linspace(0, 1, precision)
     ax.plot(baseline, baseline, '--b', label="baseline")
-    FPR = np.zeros(precision)
-    TPR = np.zeros(precision)
-    for i in range(1, len(baseline)-1):
-        new_predicted = np.zeros(predicted.shape)
-        new_predicted[np.argwhere(predicted>baseline[i])] = 1
-        TPR[i] = compute_recall(true, new_predicted, true_val, false_val)
-        FPR[i] = compute_false_positive_rate(true, new_predicted, true_val, false_val)
-    FPR[-1] = 1.
-    TPR[-1] = 1.
-    auc = compute_auc_roc(true, predicted, TPR=TPR)
+    FPR, TPR, _ = compute_roc_curve(true, predicted, true_val, false_val)
+    auc = compute_auc_roc(true, predicted, true_val, false_val, TPR=TPR, FPR=FPR)
+    if FPR.shape[0]>precision:
+        kept = np.linspace(0, FPR.shape[0]-1, precision).astype(int)
+        FPR, TPR = FPR[kept], TPR[kept]
     label = label + " (auc={:.2f})".format(auc)
     ax.plot(FPR, TPR, label=label)
     ax.set_title("ROC curve")
@@ -195,43 +537,178 @@ def display_roc_curve(true, predicted, true_val = 1, false_val = 0, ax=None, lab
 
 """
 Returns the area under the ROC curve. True and predicted must be 1d arrays
-This is calculated using the trapezoidal rule with the number of intervals equal to the precision parameter.
-It can also be calculated from a true positive rate array already given.
+This is calculated exactly as the probability that a random positive sample gets a higher score than a random negative one, ties counting for one half (the rank statistic of Mann-Whitney).
+The scores of the positives and of the negatives are sorted separately, then the number of negatives below each positive is found with a binary search, which only takes O(n log n).
+When the FPR and TPR arrays of the ROC curve are given (see compute_roc_curve), the area is calculated from them with the trapezoidal rule, which gives the same value.
+For compatibility, a true positive rate array given alone is still integrated over evenly spaced thresholds as before. precision isn't used anymore.
+"""
+def compute_auc_roc(true, predicted, true_val = 1, false_val = 0, TPR=None, precision=1000, FPR=None):
+    if TPR is not None and FPR is None:
+        return (1+2*(np.sum(TPR)-1))*(1/(2*TPR.shape[0]))
+    if TPR is not None:
+        return np.sum((FPR[1:]-FPR[:-1])*(TPR[1:]+TPR[:-1]))/2
+    if true.shape[0]!=predicted.shape[0]:
+        print(f"True and predicted must have same length but found {true.shape[0]} and {predicted.shape[0]}")
+        return
+    positives = np.sort(predicted[true==true_val])
+    negatives = np.sort(predicted[true==false_val])
+    below = np.searchsorted(negatives, positives, side="left")
+    below_or_equal = np.searchsorted(negatives, positives, side="right")
+    return (np.sum(below)+0.5*np.sum(below_or_equal-below))/(positives.shape[0]*negatives.shape[0])
+
 """
-def compute_auc_roc(true, predicted, true_val = 1, false_val = 0, TPR=None, precision=1000):
-    if TPR is None:
-        if true.shape[0]!=predicted.shape[0]:
-            print(f"True and predicted must have same length but found {true.shape[0]} and {predicted.shape[0]}")
-            return
-        TPR = np.zeros(precision)
-        thresholds = np.linspace(0, 1, precision)
-        for i in range(-1, len(thresholds)-1):
-            new_predicted = np.zeros(predicted.shape)
-            new_predicted[np.argwhere(predicted>thresholds[i])] = 1
-            TPR[i] = compute_recall(true, new_predicted, true_val, false_val)
-        TPR[-1] = 1.
-    score = (1+2*(np.sum(TPR)-1))*(1/(2*TPR.shape[0]))
-    return score
+Returns bootstrap confidence intervals of classification metrics as a dict of metric: (value, low, high), value being the metric on the whole data. True and predicted must be 1d arrays
+   metrics - names of properties of ConfusionMatrix (precision, recall, f1_score, matthews_correlation_coefficient, accuracy...), the rates being the ones of true_val, and "auc_roc" which needs scores
+   scores - the continuous predictions from which the area under the ROC curve is computed
+   n_replicates - the number of bootstrap samples
+   confidence - the confidence level of the percentile intervals
+The samples are never drawn one by one for the confusion based metrics: the counts of a bootstrap sample in the cells of the confusion matrix (plus one cell for the samples of other labels) follow a multinomial distribution,
+so all the replicates are drawn at once as a (n_replicates, cells) matrix and the metrics are computed on the stack of confusion matrices.
+The area under the ROC curve is computed from the counts of the replicates in the cells (score, label) as in compute_auc_roc. With few distinct scores, these counts are also drawn from a multinomial distribution, block by block.
+Otherwise the positives and negatives are sorted once, and each replicate only takes the counts of the samples (a bincount of n random indices), a cumulative sum of the counts of the negatives and a dot product with the counts of the positives.
+Replicates where a metric is undefined (e.g. no predicted positive for the precision) are left out of its interval.
+"""
+def bootstrap_confidence_intervals(true, predicted, scores=None, metrics=("precision", "recall", "f1_score", "matthews_correlation_coefficient", "auc_roc"), true_val = 1, false_val = 0, n_replicates=1000, confidence=0.95, random_seed=None):
+    if true.shape[0]!=predicted.shape[0]:
+        print(f"True and predicted must have same length but found {true.shape[0]} and {predicted.shape[0]}")
+        return
+    if "auc_roc" in metrics and (scores is None or scores.shape[0]!=true.shape[0]):
+        print("The area under the ROC curve needs scores of the same length as true")
+        return
+    rng = np.random.default_rng(random_seed)
+    n_samples = true.shape[0]
+    quantiles = [(1-confidence)/2, (1+confidence)/2]
+    intervals = dict()
+    confusion = compute_confusion_matrix(true, predicted, true_val, false_val)
+    cells = np.append(confusion.matrix.ravel(), n_samples-confusion.total)
+    replicates = ConfusionMatrix(rng.multinomial(n_samples, cells/n_samples, size=n_replicates)[:, :-1].reshape(n_replicates, 2, 2), confusion.labels)
+    for metric in metrics:
+        if metric=="auc_roc":
+            continue
+        value, values = getattr(confusion, metric), getattr(replicates, metric)
+        if values.ndim==2:
+            value, values = value[0], values[:, 0]
+        intervals[metric] = (value, *np.nanquantile(values, quantiles))
+    if "auc_roc" in metrics:
+        values = bootstrap_auc_roc(true, scores, true_val, false_val, n_replicates, rng)
+        intervals["auc_roc"] = (compute_auc_roc(true, scores, true_val, false_val), *np.nanquantile(values, quantiles))
+    return intervals
+
+"""
+Returns the areas under the ROC curve of n_replicates bootstrap samples drawn with the generator rng (see bootstrap_confidence_intervals).
+"""
+def bootstrap_auc_roc(true, scores, true_val, false_val, n_replicates, rng):
+    n_samples = true.shape[0]
+    areas = np.empty(n_replicates)
+    is_positive = true==true_val
+    kept = is_positive | (true==false_val)
+    distinct, groups = np.unique(scores[kept], return_inverse=True)
+    # Drawing the counts of C cells from a multinomial distribution costs about C binomial draws per replicate, against n_samples random indices otherwise
+    n_cells = 2*distinct.shape[0]+1
+    if 16*n_cells<n_samples:
+        cells = np.append(np.bincount(2*groups+is_positive[kept], minlength=n_cells-1), n_samples-groups.shape[0])
+        block_size = max(1, 2**22//n_cells)
+        for start in range(0, n_replicates, block_size):
+            counts = rng.multinomial(n_samples, cells/n_samples, size=min(block_size, n_replicates-start))
+            negatives = counts[:, 0:-1:2]
+            positives = counts[:, 1:-1:2]
+            below = np.cumsum(negatives, axis=1)-negatives
+            with np.errstate(divide="ignore", invalid="ignore"):
+                areas[start:start+counts.shape[0]] = np.sum(positives*(below+0.5*negatives), axis=1)/(positives.sum(axis=1)*negatives.sum(axis=1))
+        return areas
+    positives = np.sort(scores[is_positive])
+    negatives = np.sort(scores[true==false_val])
+    n_positives, n_negatives = positives.shape[0], negatives.shape[0]
+    below = np.searchsorted(negatives, positives, side="left")
+    below_or_equal = np.searchsorted(negatives, positives, side="right")
+    ties = not np.array_equal(below, below_or_equal)
+    # The samples are resampled through their position in [positives, negatives, others], their order not mattering
+    cumulative_negatives = np.zeros(n_negatives+1)
+    for replicate in range(0, n_replicates):
+        counts = np.bincount(rng.integers(0, n_samples, n_samples), minlength=n_samples)
+        np.cumsum(counts[n_positives:n_positives+n_negatives], out=cumulative_negatives[1:])
+        if ties:
+            numerator = 0.5*np.dot(counts[:n_positives], cumulative_negatives[below]+cumulative_negatives[below_or_equal])
+        else:
+            numerator = np.dot(counts[:n_positives], cumulative_negatives[below])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            areas[replicate] = numerator/(np.sum(counts[:n_positives])*cumulative_negatives[-1])
+    return areas
+
+"""
+Returns total/weight, the mean of a sum accumulated by log_loss_sums or brier_score_sums, or nan when there is no sample (or all the weights are 0).
+"""
+def weighted_mean(total, weight):
+    if weight==0:
+        return np.nan
+    return total/weight
+
+"""
+Returns the sum of the log losses of the predictions, weighted by sample_weight, and the sum of the weights (the number of samples without weights).
+The predictions are clipped to [eps, 1-eps] so that hard 0 or 1 predictions give a finite loss, eps being at least the machine epsilon of their dtype (e.g. float32).
+The arrays are read block_size samples at a time into two buffers of the dtype of predicted that every operation writes into (out=), so the memory used doesn't depend on the number of samples. The sums are kept in float64.
+"""
+def log_loss_sums(true, predicted, eps=1e-15, sample_weight=None, block_size=65536):
+    dtype = predicted.dtype if np.issubdtype(predicted.dtype, np.floating) else np.float64
+    eps = max(eps, np.finfo(dtype).eps)
+    clipped = np.empty(min(block_size, predicted.shape[0]), dtype=dtype)
+    complement = np.empty_like(clipped)
+    loss = 0.
+    for start in range(0, predicted.shape[0], block_size):
+        end = min(start+block_size, predicted.shape[0])
+        p, log_complement = clipped[:end-start], complement[:end-start]
+        np.clip(predicted[start:end], eps, 1-eps, out=p)
+        np.negative(p, out=log_complement)
+        np.log1p(log_complement, out=log_complement)
+        np.log(p, out=p)
+        # true*log(p)+(1-true)*log(1-p), which also holds for soft labels in [0, 1]
+        np.subtract(p, log_complement, out=p)
+        np.multiply(p, true[start:end], out=p)
+        np.add(p, log_complement, out=p)
+        if sample_weight is None:
+            loss -= np.sum(p, dtype=np.float64)
+        else:
+            loss -= np.dot(p.astype(np.float64, copy=False), sample_weight[start:end])
+    return loss, (predicted.shape[0] if sample_weight is None else np.sum(sample_weight, dtype=np.float64))
+
+"""
+Returns the sum of the squared errors of the predictions, weighted by sample_weight, and the sum of the weights, block by block as log_loss_sums.
+"""
+def brier_score_sums(true, predicted, sample_weight=None, block_size=65536):
+    dtype = predicted.dtype if np.issubdtype(predicted.dtype, np.floating) else np.float64
+    buffer = np.empty(min(block_size, predicted.shape[0]), dtype=dtype)
+    squared_error = 0.
+    for start in range(0, predicted.shape[0], block_size):
+        end = min(start+block_size, predicted.shape[0])
+        error = buffer[:end-start]
+        np.subtract(predicted[start:end], true[start:end], out=error)
+        np.multiply(error, error, out=error)
+        if sample_weight is None:
+            squared_error += np.sum(error, dtype=np.float64)
+        else:
+            squared_error += np.dot(error.astype(np.float64, copy=False), sample_weight[start:end])
+    return squared_error, (predicted.shape[0] if sample_weight is None else np.sum(sample_weight, dtype=np.float64))
 
 """
 Returns the log loss of the prediction. True and predicted must be 1d arrays
 This is usually the loss function that the classifier tries to optimize
+The predictions are clipped to [eps, 1-eps] and the loss is computed block by block with constant extra memory (see log_loss_sums). With sample_weight, this is the weighted mean of the losses.
 """
-def compute_log_loss(true, predicted):
+def compute_log_loss(true, predicted, eps=1e-15, sample_weight=None, block_size=65536):
     if true.shape[0]!=predicted.shape[0]:
         print(f"True and predicted must have same length but found {true.shape[0]} and {predicted.shape[0]}")
         return
-    res = 0
-    res -= np.sum(true*np.log(predicted))
-    res -= np.sum((1-true)*np.log((1-predicted)))
-    return res/true.shape[0]
+    loss, weight = log_loss_sums(true, predicted, eps, sample_weight, block_size)
+    return weighted_mean(loss, weight)
 
 """
 Returns the brier score. True and predicted must be 1d arrays
 It is a measure of how far the predictions are from the truth, computed simply with the mean squared error divided by the number of observations.
+It is computed block by block with constant extra memory (see brier_score_sums). With sample_weight, this is the weighted mean of the squared errors.
 """
-def compute_brier_score(true, predicted):
+def compute_brier_score(true, predicted, sample_weight=None, block_size=65536):
     if true.shape[0]!=predicted.shape[0]:
         print(f"True and predicted must have same length but found {true.shape[0]} and {predicted.shape[0]}")
         return
-    return np.sum((true-predicted)**2)/true.shape[0]
+    squared_error, weight = brier_score_sums(true, predicted, sample_weight, block_size)
+    return weighted_mean(squared_error, weight)
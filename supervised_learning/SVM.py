@@ -4,8 +4,11 @@ sys.path.append("../misc/metrics")
 
 import numpy as np
 import pandas as pd
+from collections import OrderedDict
+from itertools import product
 import normal_scaler
-from copy import deepcopy
+from dataset import Dataset, encodeLabels
+from sharedArrays import runInPool
 from classification_metrics import compute_recall, compute_precision, compute_f1_score
 
 """
@@ -19,70 +22,219 @@ Rescaling elements yields max |1|/||w||. Here, maximizing 1/||w|| is the same as
 The second term is the errors of prediction weighted by the parameter C. 
 In the array errors, the negative terms mean that the prediction is correct. Therefore, only errors>0 is considered in the loss function.
 Also, W[0] is the intercept, usually called b in the equations.
+With block_size, the errors are computed block_size terms at a time, so that no array as long as the data is allocated.
 """
 
-def cost_function(W, X, y, C=1):
+def cost_function(W, X, y, C=1, block_size=None):
     n_obs = X.shape[0]
+    if block_size==None:
+        block_size = n_obs
     first_term = (1/2)*np.dot(W,W)
-    errors = 1-(y*(np.dot(X,W[1:])+W[0]))
-    second_term = (C/n_obs)*np.sum(errors[errors>0])
+    errors_sum = 0
+    for i in range(0, n_obs, block_size):
+        errors = 1-(y[i:i+block_size]*(np.dot(X[i:i+block_size],W[1:])+W[0]))
+        errors_sum += np.sum(errors[errors>0])
+    second_term = (C/n_obs)*errors_sum
     return first_term+second_term
 
 """
 Here we compute the gradien with respect to w of the loss function defined previously. 
 This happens to be only W for terms correctly predicted and W-(C*y[i]*x[i]) if i was wrongly predicted.
 for the intercept x[i] will always be 1 so no need to consider it in the multiplication.
+Averaged over the batch, this is W minus C times the mean of y[i]*x[i] over the wrongly predicted terms, so the whole batch only takes two matrix-vector products:
+one for the errors and one for the sum of y[i]*x[i], where the terms correctly predicted get a weight of 0.
+With return_errors=True, the sum of the positive errors of the batch (the second term of the cost function before weighting) is returned along with the gradient, as it comes for free.
 """
 
-def cost_gradient(W, X, y, C):
+def cost_gradient(W, X, y, C, return_errors=False):
     n_obs = X.shape[0]
     errors = 1-(y*(np.dot(X,W[1:])+W[0]))
-    dw = np.zeros(W.shape[0])
-    counter = -1
-    for error in errors:
-        counter+=1
-        if error<0:
-            dw = dw + W
-        else:
-            dw[1:] = dw[1:] + (W[1:] - (C*y[counter]*X[counter]))
-            dw[0] = dw[0] + W[0] - (C*y[counter])
-    dw = dw / n_obs
+    weighted_y = np.where(errors>=0, y, 0)
+    dw = W.copy()
+    dw[1:] -= (C/n_obs)*np.dot(weighted_y, X)
+    dw[0] -= (C/n_obs)*np.sum(weighted_y)
+    if return_errors:
+        return dw, np.sum(errors[errors>0])
     return dw
 
 """
-Here we compute the gradient descent which is the training of the model. First x_train and y_train are declared and we add the intercept to x_train. 
-They are declare as new arrays because they are shuffled later. They are shuffled so that each iteration of the gradient descent is different in that data is passed in a different order.
+Step schedules of the gradient descent, turning the gradient of each batch into the update of the weights:
+   constant - learning_rate*dw
+   pegasos - dw/t at the t-th update, the step 1/(lambda*t) of Pegasos, lambda being 1 for the cost function above (the margin term is (1/2)*np.dot(W,W)). learning_rate isn't used.
+   adagrad - learning_rate*dw/sqrt(sum of the past dw**2), a rate per weight which decreases faster for the weights with large gradients
+   adam - learning_rate*m/sqrt(v), where m and v are moving averages of dw and dw**2 (with the usual bias correction)
+The adaptive schedules (adagrad and adam) work with much larger learning rates than the constant one, 0.01 to 0.1 being usual.
+With averaged=True, the weights returned are the average of the weights over all the updates (averaged SGD), which smooths the noise of the updates out.
+"""
+class StepSchedule:
+
+    def __init__(self, schedule, learning_rate, n_weights, averaged=False):
+        if schedule not in ("constant", "pegasos", "adagrad", "adam"):
+            print(f"Unknown schedule {schedule}, please use either constant, pegasos, adagrad or adam")
+            exit(0)
+        self.schedule = schedule
+        self.learning_rate = learning_rate
+        self.averaged = averaged
+        self.t = 0
+        self.first_moment = np.zeros(n_weights)
+        self.second_moment = np.zeros(n_weights)
+        self.average = None
+
+    """
+    Returns the weights after the update for the gradient dw.
+    """
+    def update(self, weights, dw):
+        self.t += 1
+        if self.schedule=="constant":
+            weights = weights - (self.learning_rate * dw)
+        elif self.schedule=="pegasos":
+            weights = weights - (dw / self.t)
+        elif self.schedule=="adagrad":
+            self.second_moment += dw**2
+            weights = weights - (self.learning_rate * dw / (np.sqrt(self.second_moment)+1e-8))
+        else:
+            self.first_moment = 0.9*self.first_moment + 0.1*dw
+            self.second_moment = 0.999*self.second_moment + 0.001*dw**2
+            m = self.first_moment/(1-0.9**self.t)
+            v = self.second_moment/(1-0.999**self.t)
+            weights = weights - (self.learning_rate * m / (np.sqrt(v)+1e-8))
+        if self.averaged:
+            self.average = weights.copy() if self.average is None else self.average + (weights-self.average)/self.t
+        return weights
+
+    """
+    Returns the weights to use as the result of the training so far: the averaged weights with averaged SGD, the current ones otherwise.
+    """
+    def result(self, weights):
+        if self.averaged and self.average is not None:
+            return self.average
+        return weights
+
+"""
+Here we compute the gradient descent which is the training of the model.
+The data is passed in a different order at each iteration so that each iteration of the gradient descent is different. Rather than shuffling copies of X and y, a permutation of the indices of the terms is shuffled in place
+and each batch is gathered from X and y with it, so that after the start, training only allocates arrays of the size of a batch.
 The weights are initialized at random between 0 and 1, another possibility is to initialize them to be 0.
 In each iteration, we go through the whole data in batches and update the weights according to the gradient of the cost function.
 After each data is passed we check if this iteration has decreased the cost. If the cost wasn't decreased enough, the algorithm is stopped there.
+X can also be a Dataset, whose labels are used when y is None.
+With batch_size="auto", the batches hold 1/32 of the data (and at least 256 terms), so that an epoch is a few dozens of matrix-vector products however large the data is.
+The gradient being averaged over the batch, an epoch then makes about 32 updates instead of one per term: the default learning_rate is meant for batch_size=1, so use "auto" with a larger learning_rate or with the pegasos, adagrad or adam schedule.
+The updates follow the given schedule, with or without averaging (see StepSchedule).
+With tolerance_sample, the cost used for early stopping is computed on that many terms drawn once at random, instead of the whole data.
+The weights, the order of the terms and the tolerance sample are drawn from random_generator, a numpy Generator, or from the global numpy random state by default.
+That cost is computed by blocks of 65536 terms whatever the batch_size, so that it stays a few matrix-vector products even when batch_size=1.
 """
 
-def gradient_descent(X, y, batch_size=1, epochs=100, learning_rate=0.0001, C=5, cost_threshold=0.001):
-    x_train = deepcopy(X)
-    y_train = deepcopy(y)
-    weights = np.random.rand(x_train.shape[1]+1)
-    #weights = np.zeros(x_train.shape[1]+1)
+def gradient_descent(X, y, batch_size=1, epochs=100, learning_rate=0.0001, C=5, cost_threshold=0.001, schedule="constant", averaged=False, tolerance_sample=None, random_generator=None):
+    if isinstance(X, Dataset):
+        if y is None:
+            y = X.y
+        X = X.toArray()
+    if batch_size=="auto":
+        batch_size = min(X.shape[0], max(256, X.shape[0]//32))
+    if random_generator is None:
+        random_generator = np.random
+    weights = random_generator.random(X.shape[1]+1)
+    #weights = np.zeros(X.shape[1]+1)
+    steps = StepSchedule(schedule, learning_rate, weights.shape[0], averaged)
+    order = np.arange(X.shape[0])
+    if tolerance_sample!=None and tolerance_sample<X.shape[0]:
+        sample = np.sort(random_generator.choice(X.shape[0], tolerance_sample, replace=False))
+        X_cost, y_cost = X[sample], y[sample]
+    else:
+        X_cost, y_cost = X, y
     prev_cost = float("inf")
     for _ in range(0, epochs):
 
-        # Shuffle the arrays to get different subsets each iterations, usefull when batch_size>1
-        inter = np.concatenate((x_train, y_train.reshape(-1, 1)), axis=1)
-        np.random.shuffle(inter)
-        x_train = inter[:,:-1]
-        y_train = inter[:,-1]
-        for i in range(0, x_train.shape[0], batch_size):
+        # Shuffle the order of the terms to get different subsets each iterations, usefull when batch_size>1
+        random_generator.shuffle(order)
+        for i in range(0, X.shape[0], batch_size):
             # Update weights according to gradient of cost function
-            dw = cost_gradient(weights, x_train[i:i+batch_size], y_train[i:i+batch_size], C)
-            weights = weights - (learning_rate * dw)
+            batch = order[i:i+batch_size]
+            dw = cost_gradient(weights, X[batch], y[batch], C)
+            weights = steps.update(weights, dw)
         
         # Early stopping criterion if the value of the cost function doesn't change much. Can be prevented by setting cost_threshold=0
-        cost = cost_function(weights, x_train, y_train, C)
+        cost = cost_function(steps.result(weights), X_cost, y_cost, C, block_size=65536)
         if np.abs(cost-prev_cost) < cost_threshold * prev_cost:
-            return weights
+            return steps.result(weights)
         else:
             prev_cost = cost
     
-    return weights
+    return steps.result(weights)
+
+"""
+Same training as gradient_descent for data that doesn't fit in memory. chunks is any object that can be iterated over several times (once per epoch) and gives (X_chunk, y_chunk) pairs, such as ChunkedCSV or ChunkedArrays.
+Each chunk is loaded once per epoch, its terms are shuffled and it is passed in batches as in gradient_descent.
+The cost used for early stopping is computed during the same pass: the errors of each batch are summed with the weights used for its update, and the first term uses the weights at the end of the epoch.
+This is an estimate of the cost of the final weights which doesn't need a second pass over the data. The updates follow the given schedule, as in gradient_descent.
+If the chunks hold no terms at all, nothing is trained and None is returned.
+"""
+
+def stream_gradient_descent(chunks, batch_size=1, epochs=100, learning_rate=0.0001, C=5, cost_threshold=0.001, schedule="constant", averaged=False):
+    weights = None
+    prev_cost = float("inf")
+    for _ in range(0, epochs):
+        n_obs = 0
+        errors_sum = 0
+        for X_chunk, y_chunk in chunks:
+            X_chunk = np.asarray(X_chunk)
+            y_chunk = np.asarray(y_chunk)
+            if weights is None:
+                weights = np.random.rand(X_chunk.shape[1]+1)
+                steps = StepSchedule(schedule, learning_rate, weights.shape[0], averaged)
+            chunk_batch_size = min(X_chunk.shape[0], max(256, X_chunk.shape[0]//32)) if batch_size=="auto" else batch_size
+            order = np.random.permutation(X_chunk.shape[0])
+            for i in range(0, X_chunk.shape[0], chunk_batch_size):
+                batch = order[i:i+chunk_batch_size]
+                dw, batch_errors = cost_gradient(weights, X_chunk[batch], y_chunk[batch], C, return_errors=True)
+                weights = steps.update(weights, dw)
+                errors_sum += batch_errors
+            n_obs += X_chunk.shape[0]
+        if n_obs==0:
+            print("The chunks given to stream_gradient_descent hold no terms, there is nothing to train on")
+            return
+
+        # Early stopping criterion if the value of the cost function doesn't change much. Can be prevented by setting cost_threshold=0
+        cost = (1/2)*np.dot(steps.result(weights), steps.result(weights)) + (C/n_obs)*errors_sum
+        if np.abs(cost-prev_cost) < cost_threshold * prev_cost:
+            return steps.result(weights)
+        else:
+            prev_cost = cost
+
+    return steps.result(weights)
+
+"""
+Chunks of a CSV file for stream_gradient_descent, read chunk_size lines at a time with pandas. Iterating over it again reads the file again from the start.
+label is the name of the label column, the other columns being the features. The labels are mapped with the labels dictionary when given (e.g. {"good": 1, "bad": -1}), see encodeLabels.
+"""
+class ChunkedCSV:
+
+    def __init__(self, path, label, chunk_size=100000, labels=None, dtype=np.float64):
+        self.path = path
+        self.label = label
+        self.chunkSize = chunk_size
+        self.labels = labels
+        self.dtype = dtype
+
+    def __iter__(self):
+        for chunk in pd.read_csv(self.path, chunksize=self.chunkSize):
+            yield chunk.drop(columns=[self.label]).to_numpy(dtype=self.dtype), encodeLabels(chunk[self.label].to_numpy(), self.labels)
+
+"""
+Chunks of arrays for stream_gradient_descent, chunk_size terms at a time. Meant for np.memmap arrays (or np.load with mmap_mode="r"), of which only the current chunk is read into memory.
+"""
+class ChunkedArrays:
+
+    def __init__(self, X, y, chunk_size=100000):
+        self.X = X
+        self.y = y
+        self.chunkSize = chunk_size
+
+    def __iter__(self):
+        for i in range(0, self.X.shape[0], self.chunkSize):
+            yield np.asarray(self.X[i:i+self.chunkSize]), np.asarray(self.y[i:i+self.chunkSize])
 
 """
 Here the function predicts the label for the x values given using the weights given (calculated using the gradient_descent function).
@@ -90,9 +242,222 @@ the numpy.sign function returns 0 for the values equal to 0 so we add predicted=
 """
 
 def predict_values(W, X):
+    if isinstance(X, Dataset):
+        X = X.toArray()
     predicted = np.dot(X, W[1:])+W[0]
     return np.sign(predicted)+(predicted==0)
 
+"""
+Trains gradient_descent with one configuration, a dict holding its parameters (C, learning_rate, batch_size, epochs, cost_threshold, schedule, averaged, tolerance_sample, any of them being optional) and its seed.
+The seed is given to gradient_descent through its own Generator, so the global numpy random state of the caller is left untouched.
+If the configuration has a positive_class, the model is the one-vs-rest model of that class: the labels are 1 for that class and -1 for the others.
+"""
+
+def fit_configuration(X, y, configuration):
+    if "positive_class" in configuration:
+        y = np.where(y==configuration["positive_class"], 1, -1)
+    parameters = {key: value for key, value in configuration.items() if key in ("C", "learning_rate", "batch_size", "epochs", "cost_threshold", "schedule", "averaged", "tolerance_sample")}
+    return gradient_descent(X, y, random_generator=np.random.default_rng(configuration["seed"]), **parameters)
+
+"""
+Trains one model per configuration (see fit_configuration) and returns their weights in the same order.
+With n_jobs>1 (or n_jobs=-1 to use all the cores), the models are trained by a pool of worker processes. X and y are copied once into shared memory, which all the workers read from, instead of being sent with every configuration.
+The seed of each configuration is derived from random_seed and its position in the list, so the results don't depend on n_jobs.
+"""
+
+def parallel_gradient_descent(X, y, configurations, n_jobs=1, random_seed=None):
+    if isinstance(X, Dataset):
+        if y is None:
+            y = X.y
+        X = X.toArray()
+    entropy = np.random.SeedSequence(random_seed).entropy
+    configurations = [dict(configuration, seed=np.random.SeedSequence(entropy, spawn_key=(i,)).generate_state(1)[0]) for i, configuration in enumerate(configurations)]
+    return runInPool((np.asarray(X), np.asarray(y)), fit_configuration, configurations, n_jobs)
+
+"""
+Returns the configurations of a grid search: every combination of the given values of C, learning_rate and batch_size, the other parameters being the same for all of them.
+"""
+
+def grid_configurations(C=[5], learning_rate=[0.0001], batch_size=[1], **parameters):
+    return [dict(parameters, C=c, learning_rate=rate, batch_size=size) for c, rate, size in product(C, learning_rate, batch_size)]
+
+"""
+Trains a one-vs-rest multi-class SVM: one model per class, separating it from the others, all of them trained in parallel (see parallel_gradient_descent).
+Returns the classes and the weights of their models as an array of shape (n_classes, n_features+1).
+"""
+
+def one_vs_rest(X, y, n_jobs=1, random_seed=None, **parameters):
+    if isinstance(X, Dataset):
+        if y is None:
+            y = X.y
+        X = X.toArray()
+    classes = np.unique(y)
+    configurations = [dict(parameters, positive_class=this_class) for this_class in classes]
+    return classes, np.array(parallel_gradient_descent(X, y, configurations, n_jobs, random_seed))
+
+"""
+Predicts the class of each term with the models of one_vs_rest: the class whose model gives the largest value.
+"""
+
+def predict_one_vs_rest(classes, W, X):
+    if isinstance(X, Dataset):
+        X = X.toArray()
+    return classes[np.argmax(np.dot(X, W[:, 1:].T)+W[:, 0], axis=1)]
+
+"""
+Computes the kernel between every row of X1 and every row of X2, as an array of shape (X1.shape[0], X2.shape[0]):
+   linear - <x1,x2>
+   poly - (gamma*<x1,x2>+coef0)**degree
+   rbf - exp(-gamma*||x1-x2||**2), where ||x1-x2||**2 is computed as ||x1||**2+||x2||**2-2*<x1,x2> so that the whole block is one matrix product.
+The squared norms of the rows of X2 can be given through norms2 when they are computed once for many calls.
+"""
+
+def kernel_function(X1, X2, kernel="rbf", gamma=1.0, degree=3, coef0=1.0, norms2=None):
+    products = np.dot(X1, X2.T)
+    if kernel=="linear":
+        return products
+    elif kernel=="poly":
+        return (gamma*products+coef0)**degree
+    elif kernel=="rbf":
+        if norms2 is None:
+            norms2 = np.einsum("ij,ij->i", X2, X2)
+        distances = np.einsum("ij,ij->i", X1, X1)[:, None] + norms2[None, :] - 2*products
+        return np.exp(-gamma*np.maximum(distances, 0))
+    else:
+        print(f"Unknown kernel {kernel}, please use either linear, poly or rbf")
+        exit(0)
+
+"""
+Least recently used cache of the rows of the kernel matrix of X (the kernel of one term with all the terms), whose size is bounded by cache_size in MB.
+The solver keeps coming back to the same few terms, so most rows are read from the cache instead of being computed again, which is what dominates the training time on large data.
+"""
+class KernelCache:
+
+    def __init__(self, X, kernel, gamma, degree, coef0, cache_size=200):
+        self.X = X
+        self.kernel = kernel
+        self.gamma = gamma
+        self.degree = degree
+        self.coef0 = coef0
+        self.norms2 = np.einsum("ij,ij->i", X, X)
+        self.maxRows = max(2, int(cache_size*(1<<20)//(8*X.shape[0])))
+        self.rows = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    """
+    Returns the kernel of term i with all the terms, from the cache if it is there.
+    """
+    def row(self, i):
+        if i in self.rows:
+            self.rows.move_to_end(i)
+            self.hits += 1
+            return self.rows[i]
+        self.misses += 1
+        row = kernel_function(self.X[i:i+1], self.X, self.kernel, self.gamma, self.degree, self.coef0, self.norms2)[0]
+        self.rows[i] = row
+        if len(self.rows)>self.maxRows:
+            self.rows.popitem(last=False)
+        return row
+
+    """
+    Returns the diagonal of the kernel matrix, without computing any row.
+    """
+    def diagonal(self):
+        if self.kernel=="rbf":
+            return np.ones(self.X.shape[0])
+        elif self.kernel=="poly":
+            return (self.gamma*self.norms2+self.coef0)**self.degree
+        return self.norms2.copy()
+
+"""
+Trains a kernel SVM by solving the dual problem: minimize (1/2)*sum(a[i]*a[j]*y[i]*y[j]*K(x[i],x[j])) - sum(a[i]) with 0<=a[i]<=C and sum(a[i]*y[i])=0, labels being -1 and 1.
+Unlike gradient_descent, C here weights the sum of the errors (not their mean), as is usual for the dual problem.
+The solver is an SMO one: at each iteration, the pair of multipliers that violates the optimality conditions the most is updated analytically, with the second order working set selection of LIBSVM
+(the first term maximizes the gradient violation, the second one the decrease of the objective given the first). The gradient of the objective is updated with the kernel rows of the two terms,
+which come from a KernelCache of cache_size MB. Training stops once the maximal violation is below tolerance.
+gamma="scale" uses 1/(n_features*X.var()), as is common for rbf.
+Returns the model as a dict holding the kernel parameters, the support vectors, their coefficients (a[i]*y[i]) and the intercept, to use with predict_kernel.
+"""
+
+def smo(X, y, C=1.0, kernel="rbf", gamma="scale", degree=3, coef0=1.0, tolerance=0.001, max_iterations=None, cache_size=200):
+    if isinstance(X, Dataset):
+        if y is None:
+            y = X.y
+        X = X.toArray()
+    X = np.asarray(X, dtype=float)
+    y = np.where(np.asarray(y)>0, 1.0, -1.0)
+    n_obs = X.shape[0]
+    if gamma=="scale":
+        gamma = 1/(X.shape[1]*X.var()) if X.var()>0 else 1.0
+    if max_iterations==None:
+        max_iterations = max(10000000, 100*n_obs)
+    cache = KernelCache(X, kernel, gamma, degree, coef0, cache_size)
+    diagonal = cache.diagonal()
+    alpha = np.zeros(n_obs)
+    gradient = -np.ones(n_obs)
+    tau = 1e-12
+
+    for iteration in range(0, max_iterations):
+        # -y*gradient must be lower in the terms that can still go up than in the ones that can still go down
+        violation = -y*gradient
+        up = ((y>0) & (alpha<C)) | ((y<0) & (alpha>0))
+        low = ((y>0) & (alpha>0)) | ((y<0) & (alpha<C))
+        i = np.argmax(np.where(up, violation, -np.inf))
+        m = violation[i]
+        M = np.min(np.where(low, violation, np.inf))
+        if m-M<tolerance:
+            break
+
+        # Second order choice of j: the largest decrease of the objective when updating the pair (i, j)
+        row_i = cache.row(i)
+        b = m-violation
+        a = diagonal[i]+diagonal-2*row_i
+        a = np.where(a>0, a, tau)
+        candidates = low & (b>0)
+        j = np.argmin(np.where(candidates, -(b**2)/a, np.inf))
+        row_j = cache.row(j)
+
+        # Analytical update of the pair along the constraint y[i]*a[i]+y[j]*a[j]=constant, clipped to the box
+        old_i, old_j = alpha[i], alpha[j]
+        step = b[j]/a[j]
+        total = y[i]*old_i+y[j]*old_j
+        alpha[i] = np.clip(old_i+y[i]*step, 0, C)
+        alpha[j] = np.clip(y[j]*(total-y[i]*alpha[i]), 0, C)
+        alpha[i] = y[i]*(total-y[j]*alpha[j])
+        gradient += y*(row_i*y[i]*(alpha[i]-old_i) + row_j*y[j]*(alpha[j]-old_j))
+    else:
+        print(f"SMO reached the maximum number of iterations ({max_iterations}) before converging")
+
+    # The intercept is given by the free support vectors (0<a<C), or by the middle of the feasible interval if there is none
+    violation = -y*gradient
+    free = (alpha>0) & (alpha<C)
+    if np.any(free):
+        intercept = np.mean(violation[free])
+    else:
+        up = ((y>0) & (alpha<C)) | ((y<0) & (alpha>0))
+        low = ((y>0) & (alpha>0)) | ((y<0) & (alpha<C))
+        intercept = (np.max(violation[up])+np.min(violation[low]))/2
+    support = alpha>0
+    return {"kernel": kernel, "gamma": gamma, "degree": degree, "coef0": coef0, "support_vectors": X[support], "dual_coef": alpha[support]*y[support], "intercept": intercept, "iterations": iteration}
+
+"""
+Predicts the labels (-1 or 1) of X with a model returned by smo. The decision value of a term is sum(dual_coef[i]*K(support_vectors[i], x)) + intercept,
+computed for batch_size terms at a time as one kernel block and one matrix-vector product, which keeps the memory used bounded.
+"""
+
+def predict_kernel(model, X, batch_size=1024):
+    if isinstance(X, Dataset):
+        X = X.toArray()
+    X = np.asarray(X, dtype=float)
+    support_vectors = model["support_vectors"]
+    norms2 = np.einsum("ij,ij->i", support_vectors, support_vectors)
+    predicted = np.empty(X.shape[0])
+    for i in range(0, X.shape[0], batch_size):
+        kernel = kernel_function(X[i:i+batch_size], support_vectors, model["kernel"], model["gamma"], model["degree"], model["coef0"], norms2)
+        predicted[i:i+batch_size] = np.dot(kernel, model["dual_coef"])+model["intercept"]
+    return np.sign(predicted)+(predicted==0)
+
 """
 Test the implementation. I am not interested in finding the best SVM classifier here, just in implementing an SVM classifier. 
 Therefore the results could be better if one was interested in playing with the parameters.
@@ -106,22 +471,14 @@ if __name__=="__main__":
     Also split the dataset in 66:33 for training:testing
     """
 
-    dataset = pd.read_csv("../misc/datasets/wine.csv")
-    for i in range(0, dataset.shape[0]):
-        if dataset.iloc[i,-1]=="good":
-            dataset.iloc[i,-1]=1
-        else:
-            dataset.iloc[i,-1]=-1
-
-    X = np.asarray(dataset)[:, :-1]
-    y = np.asarray(dataset)[:, -1]
+    dataset = Dataset.fromDataFrame(pd.read_csv("../misc/datasets/wine.csv"), label="quality", labels={"good": 1, "bad": -1})
+    split = int(len(dataset)*(66/100))
 
-    split = int(X.shape[0]*(66/100))
+    X_train = dataset.take(slice(0, split))
+    y_train = X_train.y
+    X_test = dataset.take(slice(split, None))
+    y_test = X_test.y
 
-    X_train = X[:split]
-    y_train = y[:split]
-    X_test = X[split:]
-    y_test = y[split:]
     print(f"There are {X_train.shape[0]} data for training and {X_test.shape[0]} data for testing")
     print(f"There are {X_train.shape[1]} features in each")
 
@@ -129,8 +486,8 @@ if __name__=="__main__":
     Scale data with custom made normal scaler
     """
 
-    params = normal_scaler.find_parameters(X_train)
-    normal_scaler.scale_data(X_train, params)
+    params = normal_scaler.find_parameters(X_train.numerical)
+    normal_scaler.scale_data(X_train.numerical, params)
 
     weights = gradient_descent(X_train, y_train)
     y_pred = predict_values(weights, X_test)
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+
+"""
+Typed container for the data given to the models, so that they never work on arrays of Python objects (which is what np.asarray gives for a DataFrame mixing numbers and strings).
+   numerical - the numerical columns as one contiguous float block of shape (n_samples, n_numerical), float64 by default or float32 to halve the memory
+   categorical - the categorical columns as integer codes of shape (n_samples, n_categorical), the code of a value being its index in the sorted categories of its column, -1 for values that weren't in the categories
+   y - the labels, as int8 for the usual class labels (see encodeLabels), or None
+   featureTypes - "Numerical" or "Categorical" for each column, in the order of the original data
+   categories - the sorted categories of each categorical column, None for numerical ones
+The models read the columns in their original order through toArray, the categorical codes being given to them as numbers (see encodeFeatures in decisionTree).
+"""
+class Dataset:
+
+    def __init__(self, numerical, categorical, y, featureTypes, categories):
+        self.numerical = numerical
+        self.categorical = categorical
+        self.y = y
+        self.featureTypes = featureTypes
+        self.categories = categories
+        self.shape = (numerical.shape[0], len(featureTypes))
+        self.array = None
+
+    """
+    Builds a Dataset from a DataFrame. Columns of a numerical dtype are numerical, the others are categorical.
+    label is the name of the label column, which is left out of the features. labels maps the raw labels to their integer value (e.g. {"good": 1, "bad": 0}), by default numerical labels are kept and others are replaced by their index in their sorted values.
+    To encode test data the same way as training data, give the categories of the training Dataset.
+    """
+    @classmethod
+    def fromDataFrame(cls, dataframe, label=None, labels=None, dtype=np.float64, categories=None):
+        y = None
+        if label!=None:
+            y = encodeLabels(dataframe[label].to_numpy(), labels)
+            dataframe = dataframe.drop(columns=[label])
+        featureTypes = ["Numerical" if pd.api.types.is_numeric_dtype(dataframe[column]) else "Categorical" for column in dataframe.columns]
+        return cls.fromColumns([dataframe[column].to_numpy() for column in dataframe.columns], featureTypes, y, dtype, categories)
+
+    """
+    Builds a Dataset from an array of shape (n_samples, n_features) and optional labels. A column whose first value is a string is categorical, as in inferFeatureTypes.
+    """
+    @classmethod
+    def fromArrays(cls, X, y=None, labels=None, dtype=np.float64, categories=None):
+        X = np.asarray(X)
+        featureTypes = ["Categorical" if isinstance(X[0, i], str) else "Numerical" for i in range(0, X.shape[1])]
+        if y is not None:
+            y = encodeLabels(np.asarray(y), labels)
+        return cls.fromColumns([X[:, i] for i in range(0, X.shape[1])], featureTypes, y, dtype, categories)
+
+    """
+    Builds a Dataset from its columns, encoding the categorical ones with the given categories, or with their own sorted values.
+    """
+    @classmethod
+    def fromColumns(cls, columns, featureTypes, y=None, dtype=np.float64, categories=None):
+        numericalColumns = [i for i in range(0, len(columns)) if featureTypes[i]=="Numerical"]
+        categoricalColumns = [i for i in range(0, len(columns)) if featureTypes[i]=="Categorical"]
+        numerical = np.empty((len(columns[0]), len(numericalColumns)), dtype=dtype)
+        for j, i in enumerate(numericalColumns):
+            numerical[:, j] = columns[i]
+        categorical = np.empty((len(columns[0]), len(categoricalColumns)), dtype=np.int32)
+        if categories is None:
+            categories = [None]*len(columns)
+            for j, i in enumerate(categoricalColumns):
+                categories[i], categorical[:, j] = np.unique(columns[i], return_inverse=True)
+        else:
+            for j, i in enumerate(categoricalColumns):
+                values, inverse = np.unique(columns[i], return_inverse=True)
+                codes = np.searchsorted(categories[i], values)
+                known = (codes<len(categories[i])) & (categories[i][np.minimum(codes, len(categories[i])-1)]==values)
+                categorical[:, j] = np.where(known, codes, -1)[inverse]
+        return cls(numerical, categorical, y, featureTypes, categories)
+
+    """
+    Returns all the columns in their original order as one array of the dtype of the numerical block, the categorical columns holding their codes.
+    Without categorical columns, this is the numerical block itself. The array is built once and kept.
+    """
+    def toArray(self):
+        if self.array is None:
+            if self.categorical.shape[1]==0:
+                self.array = self.numerical
+            else:
+                self.array = np.empty(self.shape, dtype=self.numerical.dtype)
+                isNumerical = np.array([featureType=="Numerical" for featureType in self.featureTypes], dtype=bool)
+                self.array[:, isNumerical] = self.numerical
+                self.array[:, ~isNumerical] = self.categorical
+        return self.array
+
+    """
+    Returns a new Dataset holding the given rows (a slice, an array of indices or a boolean mask), with the same categories.
+    """
+    def take(self, rows):
+        return Dataset(self.numerical[rows], self.categorical[rows], None if self.y is None else self.y[rows], self.featureTypes, self.categories)
+
+    """
+    Returns the column i in the original order, from the numerical or the categorical block.
+    """
+    def column(self, i):
+        position = self.featureTypes[:i].count(self.featureTypes[i])
+        if self.featureTypes[i]=="Numerical":
+            return self.numerical[:, position]
+        return self.categorical[:, position]
+
+    def __len__(self):
+        return self.shape[0]
+
+"""
+Turns the labels into a numerical array, mapping them with the labels dictionary when given. Non numerical labels without a mapping are replaced by their index in their sorted values.
+The labels are then stored as compactly as they can be without changing them (see compactLabels).
+"""
+def encodeLabels(y, labels=None):
+    if labels!=None:
+        values, inverse = np.unique(y, return_inverse=True)
+        return compactLabels(np.array([labels[value] for value in values]))[inverse]
+    if y.dtype==bool or np.issubdtype(y.dtype, np.number):
+        return compactLabels(y)
+    return compactLabels(np.unique(y, return_inverse=True)[1])
+
+"""
+Stores integer labels (or float labels that all hold integer values) in the smallest signed integer type that holds all of them, int8 for the usual class labels.
+Other labels, such as the continuous targets of a regression, are kept as they are.
+"""
+def compactLabels(y):
+    if y.shape[0]==0:
+        return y.astype(np.int8)
+    if not (y.dtype==bool or np.issubdtype(y.dtype, np.number)):
+        return y
+    if np.issubdtype(y.dtype, np.floating) and not np.array_equal(y, np.round(y)):
+        return y
+    low, high = y.min(), y.max()
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        if np.iinfo(dtype).min<=low and high<=np.iinfo(dtype).max:
+            return y.astype(dtype)
+    return y
@@ -1,8 +1,10 @@
 import sys
 sys.path.append("../misc/metrics")
 
+import heapq
 import numpy as np
 import pandas as pd
+from dataset import Dataset
 from classification_metrics import compute_recall, compute_precision, compute_f1_score
 
 """
@@ -12,10 +14,217 @@ Defines an early stopping criterion for the trees
 def allSameElements(array):
     if len(array)==1:
         return True
-    for i in range(1, array.shape[0]):
-        if not np.array_equal(array[0], array[i]):
-            return False
-    return True
+    return bool(np.all(array==array[0]))
+
+"""
+Vectorized version of the measure of a node, weighted by the share of samples that fall in this side of the split.
+total is an array holding, for every candidate split, the number of samples on this side and statistic the matching statistics returned by tableStatistic or scanStatistics.
+With the statistic S of a side of n samples, the weighted measures are (n - S/n)/sampleCount for Gini, (n*log2(n) - S)/sampleCount for Entropy and (squares - sums**2/n)/sampleCount for MSE,
+which are n/sampleCount times the Gini impurity, entropy and variance of the side.
+"""
+def weightedMeasure(statistic, total, sampleCount, measure):
+    if measure=="Gini":
+        value = total - statistic/total
+    elif measure=="Entropy":
+        value = total*np.log2(total) - statistic
+    else:
+        sums, squares = statistic
+        value = squares - sums**2/total
+    return value/sampleCount
+
+"""
+Returns the statistic used by weightedMeasure from tables whose last axis holds the class counts of a group of samples (or, for MSE, its number of samples, sum and sum of squares, see groupTable).
+It is the sum of the squared class counts for Gini, the sum of c*log2(c) over the class counts c for Entropy and the pair (sum, sum of squares) for MSE.
+"""
+def tableStatistic(table, measure):
+    if measure=="MSE":
+        return table[...,1], table[...,2]
+    if measure=="Gini":
+        return np.sum(table**2, axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.sum(np.where(table>0, table*np.log2(table), 0), axis=-1)
+
+"""
+Returns the number of samples of every group of tables built by groupTable.
+"""
+def tableTotal(table, measure):
+    if measure=="MSE":
+        return table[...,0]
+    return np.sum(table, axis=-1)
+
+"""
+Sums the samples of every group into a table of shape (nGroups, nClasses) holding the class counts of each group, where groups and y are integer codes.
+For regression (nClasses is None), the table is of shape (nGroups, 3) and holds the number of samples, the sum and the sum of squares of the values of each group.
+Both are built with a single pass over the samples whatever the number of classes.
+"""
+def groupTable(groups, y, nGroups, nClasses):
+    if nClasses==None:
+        return np.stack((np.bincount(groups, minlength=nGroups), np.bincount(groups, weights=y, minlength=nGroups), np.bincount(groups, weights=y**2, minlength=nGroups)), axis=1).astype(float)
+    return np.bincount(groups.astype(np.intp)*nClasses+y, minlength=nGroups*nClasses).reshape(nGroups, nClasses)
+
+"""
+Returns the statistics (see tableStatistic) of the lower and upper sides of the splits of sortedY after each of the given boundaries, sortedY being the labels of the samples of a node sorted along a feature and classTotals their class counts.
+Moving a sample from the upper side to the lower side only changes the count of its class, by an amount which only depends on the number of samples of its class before it (its rank in its class).
+The statistics of all the splits are thus cumulative sums over the samples, which costs O(n) whatever the number of classes. For MSE, they are the cumulative sums of the values and of their squares.
+"""
+def scanStatistics(sortedY, classTotals, boundaries, measure):
+    if measure=="MSE":
+        sums = np.cumsum(sortedY)
+        squares = np.cumsum(sortedY**2)
+        return (sums[boundaries], squares[boundaries]), (sums[-1]-sums[boundaries], squares[-1]-squares[boundaries])
+    # Stable sort by class, then the rank of a sample in its class is its position minus the position of the first sample of its class
+    byClass = np.argsort(sortedY, kind="stable")
+    ranks = np.empty(sortedY.shape[0], dtype=np.int64)
+    ranks[byClass] = np.arange(sortedY.shape[0]) - (np.cumsum(classTotals)-classTotals)[sortedY[byClass]]
+    remaining = classTotals[sortedY]-ranks
+    if measure=="Gini":
+        # (c+1)**2-c**2 = 2*c+1, computed on integers so that the statistics are exact
+        lower = np.cumsum(2*ranks+1)
+        upper = np.sum(classTotals**2) - np.cumsum(2*remaining-1)
+    else:
+        cLogC = lambda c: c*np.log2(np.maximum(c, 1))
+        lower = np.cumsum(cLogC(ranks+1)-cLogC(ranks))
+        upper = np.sum(cLogC(classTotals)) - np.cumsum(cLogC(remaining)-cLogC(remaining-1))
+    return lower[boundaries], upper[boundaries]
+
+"""
+Infers the type of each feature from the first row of the data: strings are categorical, everything else is numerical.
+"""
+def inferFeatureTypes(X):
+    featureTypes = []
+    for i in range(0, X.shape[1]):
+        featureTypes.append("Categorical" if isinstance(X[0,i], str) else "Numerical")
+    return featureTypes
+
+"""
+Turns the data into a float array where each categorical value is replaced by its code, the index of the value in the sorted list of the categories of its feature.
+Returns the encoded data along with the categories of each feature (None for numerical features). Numerical data already of type float is returned as is.
+"""
+def encodeFeatures(X, featureTypes):
+    categories = [None]*len(featureTypes)
+    if "Categorical" not in featureTypes:
+        return np.asarray(X, dtype=float), categories
+    encoded = np.empty(X.shape)
+    for i in range(0, X.shape[1]):
+        if featureTypes[i]=="Categorical":
+            categories[i], encoded[:,i] = np.unique(X[:,i], return_inverse=True)
+        else:
+            encoded[:,i] = X[:,i]
+    return encoded, categories
+
+"""
+Encodes new data with the categories found by encodeFeatures. Categories that weren't seen then get the code -1.
+A Dataset is already encoded, it should have been built with the same categories.
+"""
+def applyEncoding(X, featureTypes, categories):
+    if isinstance(X, Dataset):
+        return X.toArray()
+    if "Categorical" not in featureTypes:
+        return np.asarray(X, dtype=float)
+    encoded = np.empty(X.shape)
+    for i in range(0, X.shape[1]):
+        if featureTypes[i]=="Categorical":
+            values, inverse = np.unique(X[:,i], return_inverse=True)
+            codes = {category: code for code, category in enumerate(categories[i])}
+            encoded[:,i] = np.array([codes.get(value, -1) for value in values])[inverse]
+        else:
+            encoded[:,i] = X[:,i]
+    return encoded
+
+"""
+Codes the labels as their index in the sorted list of the classes, which are found from y unless given. The codes are stored in the smallest integer type that holds them.
+"""
+def encodeClasses(y, classes=None):
+    if classes is None:
+        classes, codes = np.unique(y, return_inverse=True)
+    else:
+        codes = np.searchsorted(classes, y)
+    return classes, codes.astype(np.uint8 if classes.shape[0]<=256 else np.intp)
+
+"""
+Quantizes every numerical feature into at most n_bins bins, stored as uint8 codes (so n_bins can't exceed 256).
+The bin edges of a feature are the midpoints between its distinct values when there are few enough of them, so that no split is lost, and its quantiles otherwise.
+A value x gets the code b such that binEdges[b-1] < x <= binEdges[b], so the code of a value is lower or equal to b exactly when the value is lower or equal to binEdges[b].
+Categorical features have no edges and are left to 0 in the codes.
+"""
+def binFeatures(X, featureTypes, n_bins=255):
+    binEdges = []
+    for i in range(0, X.shape[1]):
+        if featureTypes[i]=="Categorical":
+            binEdges.append(None)
+            continue
+        feature = np.asarray(featureColumn(X, i), dtype=float)
+        values = np.unique(feature)
+        if values.shape[0]<=n_bins:
+            edges = values[:-1] + ((values[1:]-values[:-1])/2)
+        else:
+            edges = np.unique(np.quantile(feature, np.linspace(0, 1, n_bins+1)[1:-1]))
+        binEdges.append(edges)
+    return binEdges, applyBinning(X, featureTypes, binEdges)
+
+"""
+Returns the bin codes of the data for bin edges computed beforehand by binFeatures.
+"""
+def applyBinning(X, featureTypes, binEdges):
+    binnedX = np.zeros(X.shape, dtype=np.uint8)
+    for i in range(0, X.shape[1]):
+        if featureTypes[i]=="Numerical":
+            binnedX[:,i] = np.searchsorted(binEdges[i], np.asarray(featureColumn(X, i), dtype=float), side="left")
+    return binnedX
+
+"""
+Returns the column i of X, which can be an encoded array or a Dataset (whose column is then read from its numerical or categorical block, without building the whole array).
+"""
+def featureColumn(X, i):
+    if isinstance(X, Dataset):
+        return X.column(i)
+    return X[:,i]
+
+"""
+Returns for each feature its column in the array of categorical codes built by categoricalCodes, -1 for numerical features.
+"""
+def categoricalColumns(featureTypes):
+    isCategorical = np.array([featureType=="Categorical" for featureType in featureTypes], dtype=bool)
+    return np.where(isCategorical, np.cumsum(isCategorical)-1, -1)
+
+"""
+Returns the codes of the categorical features of X (an encoded array or a Dataset) as an int32 array of shape (n_samples, n_categorical).
+In binning mode, the trees only read the bin codes of the numerical features, so these codes are all they need from the data besides binnedX.
+"""
+def categoricalCodes(X, featureTypes):
+    if isinstance(X, Dataset):
+        return X.categorical
+    return np.ascontiguousarray(X[:, categoricalColumns(featureTypes)>=0], dtype=np.int32)
+
+"""
+Returns the codes routed by binnedFlatTree for the given rows: the bin codes of the numerical features and the codes of the categorical ones (see categoricalCodes).
+"""
+def binnedRows(binnedX, categoricalX, featureTypes, rows):
+    codes = binnedX[rows].astype(np.int32)
+    columns = categoricalColumns(featureTypes)
+    codes[:, columns>=0] = categoricalX[rows]
+    return codes
+
+"""
+Returns a copy of the FlatTree routing bin codes (see binnedRows) instead of values: the threshold of each numerical split becomes the code of its bin edge, as in Node.split.
+This is how the trees of a forest fitted in binning mode predict their out-of-bag samples without the original data.
+"""
+def binnedFlatTree(flatTree, binEdges):
+    threshold = flatTree.threshold.copy()
+    for node in np.nonzero((flatTree.feature>=0) & ~flatTree.isCategorical)[0]:
+        threshold[node] = np.searchsorted(binEdges[flatTree.feature[node]], flatTree.threshold[node])
+    return FlatTree(flatTree.feature, threshold, flatTree.left, flatTree.right, flatTree.value, flatTree.isCategorical, flatTree.featureTypes, flatTree.categories, flatTree.categoryMasks)
+
+"""
+Computes the histogram of the given numerical features from the bin codes of the given rows, y holding class codes (or values for regression).
+The returned array is of shape (n_features, n_bins, n_classes) where the last axis holds the class counts of each bin, or (n_features, n_bins, 3) for regression (see groupTable).
+"""
+def computeHistogram(binnedX, y, rows, features, featureTypes, n_bins, nClasses):
+    histogram = np.zeros((binnedX.shape[1], n_bins, 3 if nClasses==None else nClasses))
+    for i in features:
+        if featureTypes[i]=="Numerical":
+            histogram[i] = groupTable(binnedX[rows, i], y[rows], n_bins, nClasses)
+    return histogram
 
 """
 Define the decision tree as nodes that can have up to two children. This decision tree works for both numerical and categorical features at the same time.
@@ -25,193 +234,317 @@ class Node:
     """
     Initialize the node with the data. To consider both categorical and numerical data, the data type is logged in self.featureTypes, which is induced from the data if not provided.
     The node is a leaf node if all of its data belongs to the same class. The prediction Value of the node is the class for which the node has most data.
+    Any number of classes is supported: the root node codes the labels as their index in self.classes (children are given classes and the coded labels), and nodes keep their class counts in self.counts.
+    With measure="MSE", the tree is a regression tree: the labels are values, the prediction is their mean and splits minimize the variance of the children (self.classes and self.counts are then None).
+    The root node then subtracts the mean of its labels from y, and its children are given the centered y along with that offset, which their predictions add back.
     The node has two children: left and right. 
     The featureSplit and featureSplitThreshold attributes are calculated in the findSplit function and represent the best feature and value to split this node.
+    If binning is given, numerical features are quantized once into at most binning bins (see binFeatures) and splits are searched on per-bin class histograms.
+    The bin edges and codes are computed by the root node, or can be given through binEdges and binnedX when they are shared between trees.
+    The splits on numerical features then only read binnedX, so the root node releases X once the codes are computed and keeps only its categorical codes (see categoricalCodes): in binning mode, a node given binnedX expects X to be these codes.
+    All the nodes of a tree share the same X, y and binnedX arrays: the samples of a node are the rows samples[start:end], where samples is an array of row indices also shared by the whole tree.
+    Expanding a node partitions its range of samples in place so that the left child gets the beginning of it and the right child the end, and no copy of the data is ever made.
+    If max_leaf_nodes is given, the tree is grown best-first and stops once it has that many leaves (see expand).
+    The samples can contain the same row several times, which is how the trees of a random forest get their bootstrap samples without copying the data.
+    Likewise, features is the list of the columns the tree can split on (all of them by default), and splits keep referring to the columns of X.
+    Categorical features are integer coded once by the root node (see encodeFeatures), so that the tree works on a numerical array. When categories is given, X is expected to be encoded already.
+    X can also be a Dataset, which is already encoded and gives its labels when y is None. In binning mode, its numerical and categorical blocks are read directly.
     """
-    def __init__(self, X, y, featureTypes=None, measure="Entropy", depth=0, max_depth=None, randomSeed=None, samples_to_split=None):
+    def __init__(self, X, y, featureTypes=None, measure="Entropy", depth=0, max_depth=None, randomSeed=None, samples_to_split=None, binning=None, binEdges=None, binnedX=None, histogram=None, samples=None, start=0, end=None, max_leaf_nodes=None, features=None, categories=None, classes=None, offset=None):
+        if isinstance(X, Dataset):
+            if y is None:
+                y = X.y
+            featureTypes, categories = X.featureTypes, X.categories
+            if binning==None:
+                X = X.toArray()
+        if featureTypes==None:
+            featureTypes = inferFeatureTypes(X)
+        if categories is None:
+            X, categories = encodeFeatures(X, featureTypes)
+        if measure not in ("Entropy", "Gini", "MSE"):
+            print(f"Unknown measure Measure, please use either Gini, Entropy or MSE as those are the only ones implemented for now")
+            exit(0)
+        if measure=="MSE":
+            y = np.asarray(y, dtype=float)
+        elif classes is None:
+            classes, y = encodeClasses(y)
         self.X = X
         self.y = y
-        if featureTypes==None:
-            self.featureTypes = []
-            for i in range(0, X.shape[1]):
-                self.featureTypes.append("Categorical" if isinstance(X[0,i], str) else "Numerical")
-        else:
-            self.featureTypes = featureTypes
+        self.categories = categories
+        self.classes = classes
+        if samples is None:
+            samples = np.arange(X.shape[0])
+        if end is None:
+            end = samples.shape[0]
+        self.samples = samples
+        self.start = start
+        self.end = end
+        self.sampleCount = end-start
+        # Regression targets are centered once on the mean of the root, so that the sums of squares of the histograms and category tables don't lose the variance to cancellation
+        if measure=="MSE" and offset is None:
+            offset = np.mean(y[samples[start:end]])
+            y = y-offset
+            self.y = y
+        self.offset = offset
+        if features is None:
+            features = list(range(0, len(featureTypes)))
+        self.features = features
+        self.featureTypes = featureTypes
+        if binning!=None and (binning<2 or binning>256):
+            print(f"Binning must be between 2 and 256 as bins are stored as uint8, recieved {binning}")
+            exit(0)
+        self.binning = binning
+        if binning!=None and (binnedX is None or isinstance(X, Dataset)):
+            if binnedX is None:
+                binEdges, binnedX = binFeatures(X, self.featureTypes, binning)
+            X = categoricalCodes(X, self.featureTypes)
+            self.X = X
+        # The column of self.X holding each feature, only categorical features having one in binning mode
+        self.columns = categoricalColumns(featureTypes) if binning!=None else np.arange(len(featureTypes))
+        self.binEdges = binEdges
+        self.binnedX = binnedX
+        self.histogram = histogram
         self.measure = measure
-        ones = np.argwhere(y==1).shape[0]
-        zeros = y.shape[0]-ones
-        if ones>zeros:
-            self.predictionValue = 1
-        else:
-            self.predictionValue = 0
-        if measure=="Entropy":
-            if ones==0 or zeros==0:
-                self.measureValue=0
-            else:
-                self.measureValue = -( ((ones/y.shape[0])*np.log2(ones/y.shape[0])) + ((zeros/y.shape[0])*np.log2(zeros/y.shape[0])) )
-        elif measure=="Gini":
-            self.measureValue = (ones/y.shape[0]) * (1 - (ones/y.shape[0])) + (zeros/y.shape[0]) * (1 - (zeros/y.shape[0]))
+        nodeY = y[samples[start:end]]
+        if measure=="MSE":
+            self.counts = None
+            self.predictionValue = offset+np.mean(nodeY)
+            self.measureValue = np.var(nodeY)
+            pure = allSameElements(nodeY)
         else:
-            print(f"Unknown measure Measure, please use either Gini or Entropy as those are the only ones implemented for now")
-            exit(0)
+            # Ties go to the lowest class
+            self.counts = np.bincount(nodeY, minlength=classes.shape[0])
+            self.predictionValue = classes[np.argmax(self.counts)]
+            self.measureValue = weightedMeasure(tableStatistic(self.counts, measure), self.sampleCount, self.sampleCount, measure)
+            pure = self.counts.max()==self.sampleCount
         self.left = None
         self.right = None
+        self.compiled = None
         self.featureSplit = None
         self.featureSplitThreshold = None
+        self.featureSplitCodes = None
         self.depth = depth
         self.maxDepth = max_depth
+        self.maxLeafNodes = max_leaf_nodes
+        self.splitImprovement = 0
+        self.featureImportances = None
         self.SubtreeDepth = 1
         if randomSeed!=None:
             np.random.seed(randomSeed)
         if samples_to_split!=None:
             if samples_to_split>0 and samples_to_split<1:
-                self.samplesToSplit = int(samples_to_split*X.shape[0])
+                self.samplesToSplit = int(samples_to_split*self.sampleCount)
             else:
                 self.samplesToSplit = int(samples_to_split)
         else:
             self.samplesToSplit=None
-        if allSameElements(self.X) or ones==y.shape[0] or ones==0 or (max_depth!=None and depth>=max_depth) or (self.samplesToSplit!=None and self.samplesToSplit>X.shape[0]):
+        if pure or (max_depth!=None and depth>=max_depth) or (self.samplesToSplit!=None and self.samplesToSplit>self.sampleCount) or self.allSameSamples():
             self.leaf=True
         else:
             self.leaf=False
 
+    """
+    Checks whether the samples of the node can't be told apart, in which case no split exists. In binning mode, numerical values falling in the same bin are the same for the tree.
+    """
+    def allSameSamples(self):
+        rows = self.samples[self.start:self.end]
+        for i in self.features:
+            if self.binning!=None and self.featureTypes[i]=="Numerical":
+                if not allSameElements(self.binnedX[rows, i]):
+                    return False
+            elif not allSameElements(self.X[rows, self.columns[i]]):
+                return False
+        return True
+
     """
     Loops through all features and all values (or threshold values) in the data to find the best split. If mutliple are found, choose one at random.
     The threshold values for numerical features are calculating by sorting all unique values and then taking the average of each pair.
+    For categorical features, the split sends a set of categories to the left: featureSplitThreshold holds their values and featureSplitCodes their codes.
+    Numerical features are sorted once per node and the statistics of each side of every threshold come from cumulative sums (see scanStatistics), so all thresholds of a feature are evaluated in one vectorized pass whatever the number of classes.
+    In binning mode, the thresholds are the bin edges and the cumulative sums are taken over the histogram of the node instead, which makes the search O(bins) per feature.
+    Splits whose improvements only differ by rounding errors are considered equally good.
     """
-    def findSplit(self):
+    def findSplit(self, randomGenerator=None):
 
         chosen = []
         bestImprovement = 0
+        tolerance = 1e-12*self.measureValue
+        rows = self.samples[self.start:self.end]
+        nodeY = self.y[rows]
+        nClasses = None if self.classes is None else self.classes.shape[0]
+        if self.binning!=None and self.histogram is None:
+            self.histogram = computeHistogram(self.binnedX, self.y, rows, self.features, self.featureTypes, self.binning, nClasses)
 
-        for i in range(0, self.X.shape[1]):
-
-            values = np.unique(self.X[:,i])
+        for i in self.features:
 
             if self.featureTypes[i]=="Categorical":
-                for value in values:
-
-                    # Calculate measure value in each split
-                    ones = np.argwhere(self.y[self.X[:,i]==value]==1).shape[0]
-                    zeros = self.y[self.X[:,i]==values].shape[0]-ones
-                    if self.measure=="Entropy":
-                        if ones==0 or zeros==0:
-                            measureLeft = 0
-                        else:
-                            ones = ones/self.y[self.X[:,i]==values].shape[0]
-                            zeros = zeros/self.y[self.X[:,i]==values].shape[0]
-                            measureLeft = (-( ones*np.log2(ones) + zeros*np.log2(zeros) )) * (self.y[self.X[:,i]==values].shape[0]/self.y.shape[0])
-                    elif self.measure=="Gini":
-                        ones = ones/self.y[self.X[:,i]==values].shape[0]
-                        zeros = zeros/self.y[self.X[:,i]==values].shape[0]
-                        measureLeft = ( ones*(1-ones)+ zeros*(1-zeros) ) * (self.y[self.X[:,i]==values].shape[0]/self.y.shape[0])
-
-                    ones = np.argwhere(self.y[self.X[:,i]!=value]==1).shape[0]
-                    zeros = self.y[self.X[:,i]!=values].shape[0]-ones
-                    if self.measure=="Entropy":
-                        if ones==0 or zeros==0:
-                            measureRight = 0
-                        else:
-                            ones = ones/self.y[self.X[:,i]!=values].shape[0]
-                            zeros = zeros/self.y[self.X[:,i]!=values].shape[0]
-                            measureRight = -( ones*np.log2(ones) + zeros*np.log2(zeros) ) * (self.y[self.X[:,i]!=values].shape[0]/self.y.shape[0])
-                    elif self.measure=="Gini":
-                        ones = ones/self.y[self.X[:,i]!=values].shape[0]
-                        zeros = zeros/self.y[self.X[:,i]!=values].shape[0]
-                        measureRight = ( ones*(1-ones)+ zeros*(1-zeros) ) * (self.y[self.X[:,i]!=values].shape[0]/self.y.shape[0])
-                        
-                    # Calculate measure improvement
-                    measureImprovement = self.measureValue-(measureLeft+measureRight)
-
-                    # Update best improvement and returned value.
-                    if measureImprovement>bestImprovement:
-                        bestImprovement = measureImprovement
-                        chosen = [(i, value)]
-                    if measureImprovement==bestImprovement:
-                        chosen.append((i, value))
-
+                # Sum the samples of every category at once. For a binary target, the best partition of the categories is one of those putting the categories
+                # with the lowest rates of positives on one side (and for regression, those with the lowest means), so only the splits along the categories sorted that way are scored.
+                # With more classes, the categories are sorted by their rate of each class in turn.
+                table = groupTable(self.X[rows, self.columns[i]].astype(np.intp), nodeY, len(self.categories[i]), nClasses)
+                counts = tableTotal(table, self.measure)
+                present = np.nonzero(counts)[0]
+                if present.shape[0]<2:
+                    continue
+                sortedBy = [1] if nClasses==None or nClasses==2 else range(0, nClasses)
+                orders = [present[np.argsort(table[present, k]/counts[present], kind="mergesort")] for k in sortedBy]
+                lowerTable = np.concatenate([np.cumsum(table[order], axis=0)[:-1] for order in orders])
+                # The candidates are only numbered here, the prefix j of the orderings being the first j%prefixes+1 categories of orders[j//prefixes]
+                # Only the chosen split has its set of categories built (see below), so the search stays O(n + k log k) per ordering
+                prefixes = present.shape[0]-1
+                thresholds = np.arange(lowerTable.shape[0])
+                lowerTotal = tableTotal(lowerTable, self.measure)
+                lowerStatistic = tableStatistic(lowerTable, self.measure)
+                upperStatistic = tableStatistic(np.sum(table, axis=0)-lowerTable, self.measure)
+            elif self.binning!=None:
+                # Every bin boundary is a threshold, the class counts below it are the cumulative sums of the histogram. Empty bins would repeat the previous split.
+                cumulativeTable = np.cumsum(self.histogram[i], axis=0)
+                binTotal = tableTotal(self.histogram[i], self.measure)
+                cumulativeTotal = tableTotal(cumulativeTable, self.measure)
+                boundaries = np.nonzero((binTotal[:-1]>0) & (cumulativeTotal[:-1]<self.sampleCount))[0]
+                if boundaries.shape[0]==0:
+                    continue
+                thresholds = self.binEdges[i][boundaries]
+                lowerTotal = cumulativeTotal[boundaries]
+                lowerStatistic = tableStatistic(cumulativeTable[boundaries], self.measure)
+                upperStatistic = tableStatistic(cumulativeTable[-1]-cumulativeTable[boundaries], self.measure)
             else:
-                for j in range(1, len(values)):
-                    threshold = values[j-1] + ((values[j]-values[j-1])/2)
-
-                    # Calculate measure value in each split
-                    ones = np.argwhere(self.y[self.X[:,i]>threshold]==1).shape[0]
-                    zeros = self.y[self.X[:,i]>threshold].shape[0]-ones
-                    if self.measure=="Entropy":
-                        if ones==0 or zeros==0:
-                            measureLeft = 0
-                        else:
-                            ones = ones/self.y[self.X[:,i]>threshold].shape[0]
-                            zeros = zeros/self.y[self.X[:,i]>threshold].shape[0]
-                            measureLeft = (-( ones*np.log2(ones) + zeros*np.log2(zeros) )) * (self.y[self.X[:,i]>threshold].shape[0]/self.y.shape[0])
-                    elif self.measure=="Gini":
-                        ones = ones/self.y[self.X[:,i]>threshold].shape[0]
-                        zeros = zeros/self.y[self.X[:,i]>threshold].shape[0]
-                        measureLeft = ( ones*(1-ones)+ zeros*(1-zeros) ) * (self.y[self.X[:,i]>threshold].shape[0]/self.y.shape[0])
-
-                    ones = np.argwhere(self.y[self.X[:,i]<threshold]==1).shape[0]
-                    zeros = self.y[self.X[:,i]<threshold].shape[0]-ones
-                    if self.measure=="Entropy":
-                        if ones==0 or zeros==0: # np.log2 throws exception if it recieves 0
-                            measureRight = 0
-                        else:
-                            ones = ones/self.y[self.X[:,i]<threshold].shape[0]
-                            zeros = zeros/self.y[self.X[:,i]<threshold].shape[0]
-                            measureRight = (-( ones*np.log2(ones) + zeros*np.log2(zeros) )) * (self.y[self.X[:,i]<threshold].shape[0]/self.y.shape[0])
-                    elif self.measure=="Gini":
-                        ones = ones/self.y[self.X[:,i]<threshold].shape[0]
-                        zeros = zeros/self.y[self.X[:,i]<threshold].shape[0]
-                        measureRight = ( ones*(1-ones)+ zeros*(1-zeros) ) * (self.y[self.X[:,i]<threshold].shape[0]/self.y.shape[0])
-
-                    # Calculate measure improvement
-                    measureImprovement = self.measureValue-(measureLeft+measureRight)
-                    
-                    # Update best improvement and returned value.
-                    if measureImprovement>bestImprovement:
-                        bestImprovement = measureImprovement
-                        chosen = [(i, threshold)]
-                    if measureImprovement==bestImprovement:
-                        chosen.append((i, threshold))
+                # Sort the feature once, then every threshold between two consecutive distinct values is scored at once with cumulative statistics
+                feature = self.X[rows, i]
+                order = np.argsort(feature, kind="mergesort")
+                sortedFeature = feature[order]
+                boundaries = np.nonzero(sortedFeature[1:]!=sortedFeature[:-1])[0]
+                if boundaries.shape[0]==0:
+                    continue
+                thresholds = sortedFeature[boundaries] + ((sortedFeature[boundaries+1]-sortedFeature[boundaries])/2)
+                lowerTotal = boundaries+1
+                # Regression values are centered on the mean of the node to keep the sums of squares accurate
+                sortedY = nodeY[order]-(self.predictionValue-self.offset) if self.measure=="MSE" else nodeY[order]
+                lowerStatistic, upperStatistic = scanStatistics(sortedY, self.counts, boundaries, self.measure)
+
+            # Calculate measure value in each split, the lower side holds the samples up to each boundary (or the categories going left)
+            upperTotal = self.sampleCount-lowerTotal
+            measureLeft = weightedMeasure(upperStatistic, upperTotal, self.sampleCount, self.measure)
+            measureRight = weightedMeasure(lowerStatistic, lowerTotal, self.sampleCount, self.measure)
+
+            # Calculate measure improvement
+            measureImprovement = self.measureValue-(measureLeft+measureRight)
+            featureImprovement = measureImprovement.max()
+
+            # Update best improvement and returned value. The candidates of categorical features are kept as (ordering, prefix length) pairs
+            if featureImprovement>=bestImprovement-tolerance:
+                best = thresholds[measureImprovement>=featureImprovement-tolerance]
+                if self.featureTypes[i]=="Categorical":
+                    best = [(orders[j//prefixes], j%prefixes+1) for j in best]
+                if featureImprovement>bestImprovement+tolerance:
+                    bestImprovement = featureImprovement
+                    chosen = []
+                chosen.extend((i, threshold) for threshold in best)
         try:
-            chosen = chosen[np.random.randint(len(chosen))]
+            chosen = chosen[np.random.randint(len(chosen)) if randomGenerator is None else randomGenerator.integers(len(chosen))]
         except ValueError:
-            print(self.X)
-            print(self.y)
+            print(self.X[rows])
+            print(nodeY)
             print(self.leaf)
             exit(0)
         self.featureSplit = chosen[0]
-        self.featureSplitThreshold = chosen[1]
+        if self.featureTypes[self.featureSplit]=="Categorical":
+            order, length = chosen[1]
+            self.featureSplitCodes = np.sort(order[:length])
+            self.featureSplitThreshold = self.categories[self.featureSplit][self.featureSplitCodes]
+        else:
+            self.featureSplitThreshold = chosen[1]
+        self.splitImprovement = bestImprovement
 
     """
-    Expand the whole tree to fit on the given data by recursively calling this function in the children nodes created and making the split according to the results returned by findSplit.
+    Expand the whole tree to fit on the given data by splitting nodes according to the results returned by findSplit until they all are leaves.
+    The nodes waiting to be split are kept in an explicit stack rather than through recursive calls, so that deep trees don't hit the recursion limit.
+    With max_leaf_nodes, they are kept in a priority queue instead, and the node whose split decreases the impurity of the tree the most (its improvement weighted by its number of samples) is always split first.
+    Once the tree has max_leaf_nodes leaves, the nodes left in the queue become leaves.
+    randomGenerator (a np.random.Generator) is given to findSplit to choose between equally good splits, the global numpy random state being used otherwise.
+    Once expanded, the nodes drop their references to the training data so that a fitted tree only holds its splits.
+    The improvements found while splitting are summed per feature into self.featureImportances, normalized to sum to 1.
     """
-    def expand(self):
-        # Only expand if this node is not a leaf node
-        if self.leaf==False:
+    def expand(self, randomGenerator=None):
+        nodes = [self]
+        if self.maxLeafNodes==None:
+            stack = [self]
+            while len(stack)>0:
+                node = stack.pop()
+                # Only expand if this node is not a leaf node
+                if node.leaf==False:
+                    node.findSplit(randomGenerator)
+                    nodeLeft, nodeRight = node.split()
+                    nodes.extend((nodeLeft, nodeRight))
+                    stack.append(nodeRight)
+                    stack.append(nodeLeft)
+        else:
+            queue = []
+            leaves = 1
+            if self.leaf==False:
+                self.findSplit(randomGenerator)
+                heapq.heappush(queue, (-self.sampleCount*self.splitImprovement, 0, self))
+            while len(queue)>0 and leaves<self.maxLeafNodes:
+                _, _, node = heapq.heappop(queue)
+                nodeLeft, nodeRight = node.split()
+                leaves += 1
+                for child in (nodeLeft, nodeRight):
+                    nodes.append(child)
+                    if child.leaf==False:
+                        child.findSplit(randomGenerator)
+                        heapq.heappush(queue, (-child.sampleCount*child.splitImprovement, len(nodes), child))
+            for _, _, node in queue:
+                node.leaf = True
+                node.featureSplit = None
+                node.featureSplitThreshold = None
+                node.featureSplitCodes = None
+
+        # Children are always created after their parent, so going through the nodes backwards gives the depth of every subtree
+        # The importance of a feature is the impurity decrease of the splits made on it, weighted by the number of samples split
+        importances = np.zeros(len(self.featureTypes))
+        for node in reversed(nodes):
+            if node.leaf==False:
+                node.SubtreeDepth = max(node.left.SubtreeDepth, node.right.SubtreeDepth) + 1
+                importances[node.featureSplit] += node.sampleCount*node.splitImprovement
+            # A fitted node doesn't need the training data anymore
+            node.X, node.y, node.binnedX, node.samples, node.histogram = None, None, None, None, None
+        if np.sum(importances)>0:
+            importances = importances/np.sum(importances)
+        self.featureImportances = importances
+        return self.SubtreeDepth + 1
 
-            self.findSplit()
-            
-            if self.featureTypes[self.featureSplit] == "Categorical":
-                X_newLeft = self.X[self.X[:,self.featureSplit]==self.featureSplitThreshold]
-                y_newLeft = self.y[self.X[:,self.featureSplit]==self.featureSplitThreshold]
-                X_newRight = self.X[self.X[:,self.featureSplit]!=self.featureSplitThreshold]
-                y_newRight = self.y[self.X[:,self.featureSplit]!=self.featureSplitThreshold]
+    """
+    Splits the node according to the results of findSplit: its samples are partitioned in place and its two children are created, but not expanded.
+    """
+    def split(self):
+        rows = self.samples[self.start:self.end].copy()
+        if self.featureTypes[self.featureSplit] == "Categorical":
+            leftMask = np.isin(self.X[rows, self.columns[self.featureSplit]], self.featureSplitCodes)
+        elif self.binning!=None:
+            leftMask = self.binnedX[rows, self.featureSplit]<=np.searchsorted(self.binEdges[self.featureSplit], self.featureSplitThreshold)
+        else:
+            leftMask = self.X[rows, self.featureSplit]<=self.featureSplitThreshold
+
+        # Partition the samples of this node in place: left samples first, right samples after
+        leftCount = np.count_nonzero(leftMask)
+        middle = self.start+leftCount
+        self.samples[self.start:middle] = rows[leftMask]
+        self.samples[middle:self.end] = rows[~leftMask]
+
+        # In binning mode, only the smallest child histogram is computed, the other one is what remains of the parent's histogram
+        histogramLeft, histogramRight = None, None
+        if self.binning!=None:
+            if leftCount<=self.sampleCount-leftCount:
+                histogramLeft = computeHistogram(self.binnedX, self.y, self.samples[self.start:middle], self.features, self.featureTypes, self.binning, None if self.classes is None else self.classes.shape[0])
+                histogramRight = self.histogram-histogramLeft
             else:
-                X_newLeft = self.X[self.X[:,self.featureSplit]<=self.featureSplitThreshold]
-                y_newLeft = self.y[self.X[:,self.featureSplit]<=self.featureSplitThreshold]
-                X_newRight = self.X[self.X[:,self.featureSplit]>self.featureSplitThreshold]
-                y_newRight = self.y[self.X[:,self.featureSplit]>self.featureSplitThreshold]
-
-            nodeLeft = Node(X=X_newLeft, y=y_newLeft, featureTypes=self.featureTypes, measure=self.measure, depth=self.depth+1, max_depth=self.maxDepth, samples_to_split=self.samplesToSplit)
-            self.left = nodeLeft
-            depthTreeLeft = nodeLeft.expand()
+                histogramRight = computeHistogram(self.binnedX, self.y, self.samples[middle:self.end], self.features, self.featureTypes, self.binning, None if self.classes is None else self.classes.shape[0])
+                histogramLeft = self.histogram-histogramRight
+            self.histogram = None
 
-            nodeRight = Node(X=X_newRight, y=y_newRight, featureTypes=self.featureTypes, measure=self.measure, depth=self.depth+1, max_depth=self.maxDepth, samples_to_split=self.samplesToSplit)
-            self.right = nodeRight
-            depthTreeRight = nodeRight.expand()
-
-            self.SubtreeDepth = max(depthTreeLeft, depthTreeRight)
-        return self.SubtreeDepth + 1
+        self.left = Node(X=self.X, y=self.y, featureTypes=self.featureTypes, measure=self.measure, depth=self.depth+1, max_depth=self.maxDepth, samples_to_split=self.samplesToSplit, binning=self.binning, binEdges=self.binEdges, binnedX=self.binnedX, histogram=histogramLeft, samples=self.samples, start=self.start, end=middle, features=self.features, categories=self.categories, classes=self.classes, offset=self.offset)
+        self.right = Node(X=self.X, y=self.y, featureTypes=self.featureTypes, measure=self.measure, depth=self.depth+1, max_depth=self.maxDepth, samples_to_split=self.samplesToSplit, binning=self.binning, binEdges=self.binEdges, binnedX=self.binnedX, histogram=histogramRight, samples=self.samples, start=middle, end=self.end, features=self.features, categories=self.categories, classes=self.classes, offset=self.offset)
+        return self.left, self.right
 
     """
     Goes through the tree to find the leaf giving the prediction for this value
@@ -222,25 +555,66 @@ class Node:
             return self.predictionValue
         else:
             if self.featureTypes[self.featureSplit] == "Categorical":
-                if value[self.featureSplit]==self.featureSplitThreshold:
+                if value[self.featureSplit] in self.featureSplitThreshold:
                     return self.left.predict_value(value)
                 else:
                     return self.right.predict_value(value)
             else:
-                if value[self.featureSplit]<self.featureSplitThreshold:
+                if value[self.featureSplit]<=self.featureSplitThreshold:
                     return self.left.predict_value(value)
                 else:
                     return self.right.predict_value(value)
 
     """
-    Iterate over all given values using the predict_value function to return all predictions at once in an array.
+    Predicts all given values at once in an array. The tree is compiled into a FlatTree the first time it is used, which then routes the whole batch through the tree.
     """
     def predict(self, to_predict):
 
-        predictions = np.zeros(to_predict.shape[0])
-        for i in range(0, to_predict.shape[0]):
-            predictions[i] = self.predict_value(to_predict[i])
-        return predictions
+        if self.compiled is None:
+            self.compiled = self.compile()
+        return self.compiled.predict(to_predict)
+
+    """
+    Compiles the fitted tree into a FlatTree. The nodes are numbered in depth-first order, the root being node 0, using an explicit stack so that deep trees don't hit the recursion limit.
+    The categories going left at each categorical split are stored as a boolean mask over all the categories of the feature, the masks of all nodes being laid end to end in one array.
+    """
+    def compile(self):
+        nodes = []
+        stack = [self]
+        while len(stack)>0:
+            node = stack.pop()
+            nodes.append(node)
+            if not node.leaf:
+                stack.append(node.right)
+                stack.append(node.left)
+        index = {id(node): i for i, node in enumerate(nodes)}
+
+        feature = np.full(len(nodes), -1, dtype=np.int32)
+        threshold = np.zeros(len(nodes))
+        left = np.full(len(nodes), -1, dtype=np.int32)
+        right = np.full(len(nodes), -1, dtype=np.int32)
+        # The values are of the type of the classes, which can be strings
+        value = np.array([node.predictionValue for node in nodes])
+        isCategorical = np.zeros(len(nodes), dtype=bool)
+        categoryMasks = []
+        maskOffset = 0
+        for i, node in enumerate(nodes):
+            if node.leaf:
+                continue
+            feature[i] = node.featureSplit
+            left[i] = index[id(node.left)]
+            right[i] = index[id(node.right)]
+            if self.featureTypes[node.featureSplit]=="Categorical":
+                isCategorical[i] = True
+                mask = np.zeros(len(self.categories[node.featureSplit]), dtype=bool)
+                mask[node.featureSplitCodes] = True
+                categoryMasks.append(mask)
+                threshold[i] = maskOffset
+                maskOffset += mask.shape[0]
+            else:
+                threshold[i] = node.featureSplitThreshold
+        categoryMasks = np.concatenate(categoryMasks) if len(categoryMasks)>0 else np.zeros(0, dtype=bool)
+        return FlatTree(feature, threshold, left, right, value, isCategorical, self.featureTypes, self.categories, categoryMasks)
 
     """
     Prints some information on the tree such as the max depth
@@ -248,27 +622,105 @@ class Node:
     def printInfo(self):
         print(f"The tree has a depth of {self.SubtreeDepth}.")
 
+"""
+Compiled form of a fitted tree, stored as parallel arrays indexed by node number (see Node.compile):
+   feature - the feature used to split the node, -1 for leaves
+   threshold - the split threshold for numerical features, or the offset of the mask of the categories going left in categoryMasks for categorical features
+   left, right - the numbers of the children of the node, -1 for leaves
+   value - the prediction of the node
+   isCategorical - whether the split is made on a categorical feature
+featureTypes and categories (those seen while fitting) are used to turn the categorical values of the data to predict into codes, which index the masks.
+"""
+class FlatTree:
+
+    def __init__(self, feature, threshold, left, right, value, isCategorical, featureTypes, categories, categoryMasks=None):
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.isCategorical = isCategorical
+        self.featureTypes = featureTypes
+        self.categories = categories
+        self.categoryMasks = categoryMasks if categoryMasks is not None else np.zeros(0, dtype=bool)
+        self.tables = None
+
+    """
+    Returns the data as a float array where categorical values are replaced by their code in self.categories, or -1 for categories not seen while fitting.
+    """
+    def encode(self, X):
+        return applyEncoding(X, self.featureTypes, self.categories)
+
+    """
+    Routes the whole batch through the tree one level at a time: at each step, every sample that hasn't reached a leaf yet moves to the child of its current node.
+    """
+    def predict(self, to_predict):
+        X = self.encode(to_predict)
+        return self.value[self.route(X, np.arange(X.shape[0]), np.zeros(X.shape[0], dtype=np.intp))]
+
+    """
+    Returns the arrays used to route samples through the tree, built once and kept: leaves point to themselves with an infinite threshold, so that samples that reached a leaf can keep moving without changing node.
+    children holds for each node its right child in the first column and its left child in the second, so that a boolean going left directly indexes it.
+    """
+    def routingTables(self):
+        if self.tables is None:
+            isLeaf = self.feature<0
+            nodes = np.arange(self.feature.shape[0])
+            feature = np.where(isLeaf, 0, self.feature).astype(np.intp)
+            threshold = np.where(isLeaf, np.inf, self.threshold)
+            children = np.stack((np.where(isLeaf, nodes, self.right), np.where(isLeaf, nodes, self.left)), axis=1).astype(np.intp)
+            self.tables = (isLeaf, feature, threshold, children)
+        return self.tables
+
+    """
+    Moves every (row, node) pair down to a leaf and returns the leaf reached by each of them. X must be encoded already.
+    Starting from other nodes than the root (or from several roots for the same row) is what lets a forest stored as one FlatTree be evaluated in a single pass.
+    Each level only costs a handful of array operations on the pairs still moving, the values being gathered from the flattened data. The pairs that reached a leaf are dropped every few levels.
+    """
+    def route(self, X, rows, node):
+        isLeaf, feature, threshold, children = self.routingTables()
+        X = np.ascontiguousarray(X)
+        flatX = X.reshape(-1)
+        hasCategorical = self.isCategorical.any()
+        leaves = np.array(node, dtype=np.intp)
+        active = np.arange(leaves.shape[0], dtype=np.intp)
+        current = leaves.copy()
+        offsets = rows.astype(np.intp)*X.shape[1]
+        level = 0
+        while current.shape[0]>0:
+            if level%4==0:
+                moving = ~isLeaf[current]
+                if not moving.all():
+                    leaves[active] = current
+                    active = active[moving]
+                    current = current[moving]
+                    offsets = offsets[moving]
+            values = flatX[offsets+feature[current]]
+            if hasCategorical:
+                # Categorical nodes look the code up in their mask, unknown categories (code -1) go right
+                categorical = self.isCategorical[current]
+                codes = np.where(categorical & (values>=0), values, 0).astype(np.intp)
+                inMask = self.categoryMasks[np.where(categorical, threshold[current], 0).astype(np.intp)+codes]
+                goLeft = np.where(categorical, (values>=0) & inMask, values<=threshold[current])
+            else:
+                goLeft = values<=threshold[current]
+            current = children[current, goLeft.view(np.int8)]
+            level += 1
+        return leaves
+
 if __name__=="__main__":
 
     """
     First, load the dataset and prepare the data by transforming quality in numerical data. 
     Also split the dataset in 66:33 for training:testing
     """
-    dataset = pd.read_csv("../misc/datasets/wine.csv")
-    for i in range(0, dataset.shape[0]):
-        if dataset.iloc[i,-1]=="good":
-            dataset.iloc[i,-1]=1
-        else:
-            dataset.iloc[i,-1]=0
-
-    X = np.asarray(dataset)[:, :-1]
-    y = np.asarray(dataset)[:, -1]
-    split = int(X.shape[0]*(66/100))
+    dataset = Dataset.fromDataFrame(pd.read_csv("../misc/datasets/wine.csv"), label="quality", labels={"good": 1, "bad": 0})
+    split = int(len(dataset)*(66/100))
 
-    X_train = X[:split]
-    y_train = y[:split]
-    X_test = X[split:]
-    y_test = y[split:]
+    X_train = dataset.take(slice(0, split))
+    y_train = X_train.y
+    X_test = dataset.take(slice(split, None))
+    y_test = X_test.y
     print(f"There are {X_train.shape[0]} data for training and {X_test.shape[0]} data for testing")
     print(f"There are {X_train.shape[1]} features in each")
 
@@ -0,0 +1,132 @@
+import json
+import numpy as np
+from decisionTree import Node, FlatTree
+from randomForest import FlatForest
+
+"""
+Binary format of the fitted trees and forests, made of their flat arrays (see Node.compile and FlatForest) so that they can be loaded without rebuilding any Python object per node:
+   magic - the 8 bytes MAGIC
+   version - the version of the format, as a little endian uint32
+   header size - the size of the header in bytes, as a little endian uint32
+   header - a JSON object holding the kind of model ("tree" or "forest"), its featureTypes, categories and classes, and the dtype, shape and offset in the file of each array
+   arrays - the arrays one after the other, each one starting at a multiple of ALIGNMENT bytes
+The routing tables of the trees (see FlatTree.routingTables) are saved as well, so a loaded model is ready to predict.
+"""
+MAGIC = b"DSMODEL\x00"
+VERSION = 1
+ALIGNMENT = 64
+
+"""
+Writes the header and the given arrays (a dict of name: array) to path.
+"""
+def writeModel(path, kind, featureTypes, categories, classes, arrays):
+    header = {"kind": kind, "featureTypes": featureTypes, "categories": [None if values is None else values.tolist() for values in categories], "classes": None if classes is None else classes.tolist(), "arrays": dict()}
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    # The offsets depend on the size of the header, which depends on the offsets, so the arrays start after enough room is left for the header
+    start = ALIGNMENT
+    while True:
+        offset = start
+        for name, array in arrays.items():
+            header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+            offset += -(-array.nbytes//ALIGNMENT)*ALIGNMENT
+        encodedHeader = json.dumps(header).encode()
+        if len(MAGIC)+8+len(encodedHeader)<=start:
+            break
+        start = -(-(len(MAGIC)+8+len(encodedHeader))//ALIGNMENT)*ALIGNMENT
+    encodedHeader = encodedHeader.ljust(start-len(MAGIC)-8)
+    with open(path, "wb") as file:
+        file.write(MAGIC)
+        file.write(np.array([VERSION, len(encodedHeader)], dtype="<u4").tobytes())
+        file.write(encodedHeader)
+        for name, array in arrays.items():
+            file.seek(header["arrays"][name]["offset"])
+            file.write(array.tobytes())
+
+"""
+Reads the header of the model saved at path and maps its arrays to memory with np.memmap. The arrays are read-only and their pages are shared by all the processes loading the same file.
+Returns the header and a dict of the arrays, or None if the file isn't a model of a version this code can read.
+"""
+def readModel(path):
+    with open(path, "rb") as file:
+        magic = file.read(len(MAGIC))
+        if magic!=MAGIC:
+            print(f"{path} is not a saved model")
+            return None
+        version, headerSize = np.frombuffer(file.read(8), dtype="<u4")
+        if version>VERSION:
+            print(f"{path} was saved with version {version} of the format, only versions up to {VERSION} can be read")
+            return None
+        header = json.loads(file.read(headerSize).decode())
+    arrays = dict()
+    for name, description in header["arrays"].items():
+        if np.prod(description["shape"])==0:
+            arrays[name] = np.zeros(description["shape"], dtype=np.dtype(description["dtype"]))
+        else:
+            arrays[name] = np.memmap(path, dtype=np.dtype(description["dtype"]), mode="r", offset=description["offset"], shape=tuple(description["shape"]))
+    return header, arrays
+
+"""
+Returns the arrays of a FlatTree to save, including its routing tables.
+"""
+def flatTreeArrays(flatTree):
+    isLeaf, routeFeature, routeThreshold, children = flatTree.routingTables()
+    return {"feature": flatTree.feature, "threshold": flatTree.threshold, "left": flatTree.left, "right": flatTree.right, "value": flatTree.value, "isCategorical": flatTree.isCategorical, "categoryMasks": flatTree.categoryMasks,
+            "isLeaf": isLeaf, "routeFeature": routeFeature, "routeThreshold": routeThreshold, "children": children}
+
+"""
+Rebuilds a FlatTree from the header and arrays read by readModel.
+"""
+def loadFlatTree(header, arrays):
+    categories = [None if values is None else np.array(values, dtype=object) for values in header["categories"]]
+    flatTree = FlatTree(arrays["feature"], arrays["threshold"], arrays["left"], arrays["right"], arrays["value"], arrays["isCategorical"], header["featureTypes"], categories, arrays["categoryMasks"])
+    flatTree.tables = (arrays["isLeaf"], arrays["routeFeature"], arrays["routeThreshold"], arrays["children"])
+    return flatTree
+
+"""
+Saves a fitted tree (a Node, or a FlatTree already compiled) to path.
+"""
+def saveTree(tree, path):
+    classes = None
+    if isinstance(tree, Node):
+        classes = tree.classes
+        tree = tree.compiled if tree.compiled is not None else tree.compile()
+    writeModel(path, "tree", tree.featureTypes, tree.categories, classes, flatTreeArrays(tree))
+
+"""
+Loads a tree saved by saveTree as a FlatTree, whose predict method works as the one of Node.
+"""
+def loadTree(path):
+    model = readModel(path)
+    if model==None:
+        return None
+    header, arrays = model
+    if header["kind"]!="tree":
+        print(f"{path} holds a {header['kind']}, not a tree")
+        return None
+    return loadFlatTree(header, arrays)
+
+"""
+Saves a forest returned by randomForest (or already compiled into a FlatForest) to path.
+"""
+def saveForest(randomForest, path):
+    if not isinstance(randomForest, FlatForest):
+        randomForest = FlatForest(randomForest)
+    arrays = flatTreeArrays(randomForest.tree)
+    arrays["roots"] = randomForest.roots
+    arrays["weights"] = randomForest.weights
+    writeModel(path, "forest", randomForest.tree.featureTypes, randomForest.tree.categories, randomForest.classes, arrays)
+
+"""
+Loads a forest saved by saveForest as a FlatForest, which can be given to randomForestPredict.
+Loading only reads the header, so it takes the same time whatever the size of the forest, the pages of the arrays being read from the file when they are first used.
+"""
+def loadForest(path):
+    model = readModel(path)
+    if model==None:
+        return None
+    header, arrays = model
+    if header["kind"]!="forest":
+        print(f"{path} holds a {header['kind']}, not a forest")
+        return None
+    classes = None if header["classes"] is None else np.array(header["classes"])
+    return FlatForest.fromArrays(loadFlatTree(header, arrays), arrays["roots"], arrays["weights"], classes)
@@ -4,12 +4,62 @@ sys.path.append("../misc/metrics")
 import numpy as np
 import pandas as pd
 from classification_metrics import compute_recall, compute_precision, compute_f1_score
-from decisionTree import Node
-from copy import deepcopy
+from decisionTree import Node, FlatTree, inferFeatureTypes, encodeFeatures, applyEncoding, encodeClasses, binFeatures, applyBinning, categoricalCodes, binnedRows, binnedFlatTree
+from sharedArrays import runInPool
+from dataset import Dataset
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import os
 
-def randomForest(X, y, forest_size=50, measure="Entropy", max_depth=None, randomSeed=None, samples_to_split=None, max_features="sqrt", tree_size=1.0, weights_initialization=list()):
-    if randomSeed!=None:
-        np.random.seed(randomSeed)
+"""
+Fits one tree of the forest. All the randomness of the tree (its features, its samples and the choice between equally good splits) comes from its own np.random.Generator, so a tree is the same whether it is fitted in the main process or in a worker, and the global random state of the caller is left untouched.
+The seed of the tree is the child number treeIndex of the forest's np.random.SeedSequence, whose entropy is stored with the tree along with treeIndex so that more trees can be added to the forest later on (see randomForestGrow).
+treeParameters holds everything that is common to all the trees of the forest.
+The tree is given the whole data, already encoded (see encodeFeatures) and with the labels coded as their index in treeParameters["classes"] for classification, along with the indices of its bootstrap sample and its list of features, so no copy of the data is made for it.
+In binning mode, X only holds the categorical codes (see categoricalCodes) and the out-of-bag samples are routed on their bin codes.
+Returns the fitted tree along with the rows left out of its bootstrap sample (out-of-bag) and its predictions for them when treeParameters["oob_score"] is set, None otherwise.
+"""
+def fitTree(X, y, binnedX, treeIndex, treeParameters):
+    randomGenerator = np.random.default_rng(np.random.SeedSequence(treeParameters["entropy"], spawn_key=(treeIndex,)))
+    this_tree_feature_list = randomGenerator.choice(len(treeParameters["featureTypes"]), size=treeParameters["tree_max_features"], replace=False).tolist()
+    chosen_samples = randomGenerator.integers(0, y.shape[0], size=treeParameters["tree_sample_size"])
+    this_tree = Node(X, y, featureTypes=treeParameters["featureTypes"], measure=treeParameters["measure"], max_depth=treeParameters["max_depth"], samples_to_split=treeParameters["samples_to_split"], binning=treeParameters["binning"], binEdges=treeParameters["binEdges"], binnedX=binnedX, samples=chosen_samples, max_leaf_nodes=treeParameters["max_leaf_nodes"], features=this_tree_feature_list, categories=treeParameters["categories"], classes=treeParameters["classes"], offset=treeParameters["offset"])
+    this_tree.expand(randomGenerator)
+    this_tree.forestEntropy = treeParameters["entropy"]
+    this_tree.treeIndex = treeIndex
+    if not treeParameters["oob_score"]:
+        return this_tree, None, None
+    oobRows = np.nonzero(np.bincount(chosen_samples, minlength=y.shape[0])==0)[0]
+    this_tree.compiled = this_tree.compile()
+    if binnedX is None:
+        oobPredictions = this_tree.compiled.value[this_tree.compiled.route(X, oobRows, np.zeros(oobRows.shape[0], dtype=np.intp))]
+        return this_tree, oobRows, oobPredictions
+    binnedTree = binnedFlatTree(this_tree.compiled, treeParameters["binEdges"])
+    oobPredictions = np.empty(oobRows.shape[0], dtype=this_tree.compiled.value.dtype)
+    # The codes of the out-of-bag rows are gathered chunk by chunk so that no copy of the whole data is made
+    for start in range(0, oobRows.shape[0], 65536):
+        rows = oobRows[start:start+65536]
+        codes = binnedRows(binnedX, X, treeParameters["featureTypes"], rows)
+        oobPredictions[start:start+rows.shape[0]] = binnedTree.value[binnedTree.route(codes, np.arange(rows.shape[0]), np.zeros(rows.shape[0], dtype=np.intp))]
+    return this_tree, oobRows, oobPredictions
+
+"""
+Fits the trees of the given indices, in the main process or in a pool of n_jobs worker processes sharing the training data (see randomForest).
+"""
+def fitTrees(X, y, binnedX, treeIndices, treeParameters, n_jobs=1):
+    return runInPool((X, y, binnedX), partial(fitTree, treeParameters=treeParameters), treeIndices, n_jobs)
+
+"""
+Fits a random forest of forest_size trees, each one on a bootstrap sample of the data and a random subset of the features.
+The seed of each tree is derived from randomSeed, which makes the forest reproducible whatever the number of processes used.
+With n_jobs>1 (or n_jobs=-1 to use all the cores), the trees are fitted by a pool of worker processes. The training data is copied once into shared memory, which all the workers read from, instead of being sent with every tree.
+With oob_score=True, each tree also predicts the samples it wasn't trained on while it is fitted, and the forest returns its out-of-bag accuracy along with the weighted out-of-bag votes (see accumulateOOBVotes).
+X can be a Dataset, in which case y defaults to its labels.
+With measure="MSE", the trees are regression trees and the forest predicts the weighted mean of their predictions. The out-of-bag score is only implemented for classification.
+"""
+def randomForest(X, y, forest_size=50, measure="Entropy", max_depth=None, randomSeed=None, samples_to_split=None, max_features="sqrt", tree_size=1.0, weights_initialization=list(), binning=None, max_leaf_nodes=None, n_jobs=1, oob_score=False):
+    if isinstance(X, Dataset) and y is None:
+        y = X.y
     if max_features=="sqrt":
         tree_max_features = int(np.sqrt(X.shape[1]))
     elif max_features=="log":
@@ -48,56 +98,243 @@ def randomForest(X, y, forest_size=50, measure="Entropy", max_depth=None, random
         if len(weights_initialization)==0:
             weights_initialization = np.ones(forest_size)
 
+    if oob_score and measure=="MSE":
+        print("The out-of-bag score is only implemented for classification, use oob_score=False with measure MSE")
+        return
+
+    # The labels and the categorical features are integer coded once for the whole forest, the trees all working on the same numerical array
+    if isinstance(X, Dataset):
+        featureTypes, categories = X.featureTypes, X.categories
+        if binning==None:
+            X = X.toArray()
+    else:
+        featureTypes = inferFeatureTypes(X)
+        X, categories = encodeFeatures(X, featureTypes)
+    # Regression targets are centered once for the whole forest (see Node), the trees being given the offset to add back
+    if measure=="MSE":
+        classes, labels = None, np.asarray(y, dtype=float)
+        offset = np.mean(labels)
+        labels = labels-offset
+    else:
+        classes, labels = encodeClasses(y)
+        offset = None
+
+    # In binning mode, the features are quantized once for the whole forest and each tree works on a subset of the codes
+    # The trees only read the bin codes and the categorical codes, so only those are kept (and shared with the workers) and the float data is released
+    if binning!=None:
+        if binning<2 or binning>256:
+            print(f"Binning must be between 2 and 256 as bins are stored as uint8, recieved {binning}")
+            return
+        binEdges, binnedX = binFeatures(X, featureTypes, binning)
+        X = categoricalCodes(X, featureTypes)
+    else:
+        binEdges, binnedX = None, None
+
+    treeParameters = {"entropy": np.random.SeedSequence(randomSeed).entropy, "featureTypes": featureTypes, "categories": categories, "classes": classes, "binEdges": binEdges, "tree_max_features": tree_max_features, "tree_sample_size": tree_sample_size, "measure": measure, "max_depth": max_depth, "samples_to_split": samples_to_split, "binning": binning, "max_leaf_nodes": max_leaf_nodes, "oob_score": oob_score, "offset": offset}
+    fitted = fitTrees(X, labels, binnedX, list(range(0, forest_size)), treeParameters, n_jobs)
+
     trees = list()
     for i in range(0, forest_size):
-        this_tree_feature_list = list()
-        while(len(this_tree_feature_list)<tree_max_features):
-            this_feature = np.random.randint(0, X.shape[1])
-            if this_feature not in this_tree_feature_list:
-                this_tree_feature_list.append(this_feature)
-        chosen_samples = np.random.randint(0, X.shape[0], size=tree_sample_size)
-        inter = np.concatenate((X, y.reshape(-1, 1)), axis=1)
-        this_tree_dataset_X = deepcopy(inter[chosen_samples,:][:,this_tree_feature_list])
-        this_tree_dataset_y = deepcopy(inter[chosen_samples,:][:, -1])
-        this_tree = Node(this_tree_dataset_X, this_tree_dataset_y, measure=measure, max_depth=max_depth, randomSeed=randomSeed, samples_to_split=samples_to_split)
-        this_tree.expand()
-        trees.append((this_tree, weights_initialization[i]))
+        trees.append((fitted[i][0], weights_initialization[i]))
+    if oob_score:
+        oobVotes = accumulateOOBVotes(fitted, weights_initialization, y)
+        return trees, randomForestOOBScore(oobVotes, y), oobVotes
     return trees
 
-def randomForestPredict(randomForest, X):
+"""
+Adds n_trees trees to a forest returned by randomForest, without refitting the trees already there, and returns the grown forest. The new trees get the given weight.
+The parameters of the new trees (features per tree, sample size, measure, depth, binning...) are the ones stored in the trees of the forest, and X and y must be the data it was fitted on.
+The new trees take the next seeds of the forest, so growing a forest of 50 trees by 50 gives the same trees as fitting 100 trees at once.
+If the out-of-bag votes of the forest are given, the new trees add theirs and the function returns the forest, its new out-of-bag score and votes as randomForest does.
+"""
+def randomForestGrow(randomForest, X, y, n_trees, weight=1.0, n_jobs=1, oob_votes=None):
+    if isinstance(X, Dataset) and y is None:
+        y = X.y
+    reference = randomForest[0][0]
+    if reference.binning==None or not isinstance(X, Dataset):
+        X = applyEncoding(X, reference.featureTypes, reference.categories)
+    if reference.classes is None:
+        labels = np.asarray(y, dtype=float)-reference.offset
+    else:
+        labels = encodeClasses(y, reference.classes)[1]
+    binnedX = None
+    if reference.binning!=None:
+        binnedX = applyBinning(X, reference.featureTypes, reference.binEdges)
+        X = categoricalCodes(X, reference.featureTypes)
+    treeParameters = {"entropy": reference.forestEntropy, "featureTypes": reference.featureTypes, "categories": reference.categories, "classes": reference.classes, "binEdges": reference.binEdges, "tree_max_features": len(reference.features), "tree_sample_size": reference.sampleCount, "measure": reference.measure, "max_depth": reference.maxDepth, "samples_to_split": reference.samplesToSplit, "binning": reference.binning, "max_leaf_nodes": reference.maxLeafNodes, "oob_score": oob_votes is not None, "offset": reference.offset}
+    nextIndex = max(this_tree.treeIndex for this_tree, _ in randomForest)+1
+    fitted = fitTrees(X, labels, binnedX, list(range(nextIndex, nextIndex+n_trees)), treeParameters, n_jobs)
+
+    trees = list(randomForest)
+    for i in range(0, n_trees):
+        trees.append((fitted[i][0], weight))
+    if oob_votes is not None:
+        oobVotes = accumulateOOBVotes(fitted, [weight]*n_trees, y, oob_votes.copy())
+        return trees, randomForestOOBScore(oobVotes, y), oobVotes
+    return trees
+
+"""
+Keeps the n_trees best trees of the forest and drops the others, the remaining trees keeping their order and weights.
+The trees are ranked on their accuracy (or mean squared error for regression) on X and y when given, and on the out-of-bag accuracy stored while fitting them with oob_score=True otherwise.
+Note that out-of-bag votes accumulated before pruning still include the votes of the dropped trees.
+"""
+def randomForestPrune(randomForest, n_trees, X=None, y=None):
+    if isinstance(X, Dataset) and y is None:
+        y = X.y
+    if X is not None and randomForest[0][0].classes is None:
+        scores = [-np.mean((this_tree.predict(X)-y)**2) for this_tree, _ in randomForest]
+    elif X is not None:
+        scores = [np.mean(this_tree.predict(X)==y) for this_tree, _ in randomForest]
+    else:
+        scores = [getattr(this_tree, "oobAccuracy", None) for this_tree, _ in randomForest]
+        if None in scores:
+            print("The trees have no out-of-bag accuracy, either fit the forest with oob_score=True or give X and y to rank the trees")
+            return
+    kept = np.sort(np.argsort(-np.array(scores), kind="stable")[:n_trees])
+    return [randomForest[i] for i in kept]
+
+"""
+Sums the out-of-bag predictions of the fitted trees into votes, weighted by the weights of the trees. The result is of shape (n_samples, n_classes), the columns following np.unique(y).
+The votes can be given to continue accumulating on top of previous ones. The out-of-bag accuracy of each tree is stored in its oobAccuracy attribute.
+"""
+def accumulateOOBVotes(fitted, weights, y, oobVotes=None):
+    classes = np.unique(y)
+    if oobVotes is None:
+        oobVotes = np.zeros((y.shape[0], classes.shape[0]))
+    for i in range(0, len(fitted)):
+        this_tree, oobRows, oobPredictions = fitted[i]
+        this_tree.oobAccuracy = np.mean(oobPredictions==y[oobRows]) if oobRows.shape[0]>0 else np.nan
+        # Each row appears once in oobRows, so there is no repeated index in the addition
+        oobVotes[oobRows, np.searchsorted(classes, oobPredictions)] += weights[i]
+    return oobVotes
+
+"""
+Returns the out-of-bag accuracy from the votes accumulated while fitting, considering only the samples that were left out by at least one tree.
+As in randomForestPredict, ties in the vote go to the highest class.
+"""
+def randomForestOOBScore(oobVotes, y):
+    classes = np.unique(y)
+    voted = np.sum(oobVotes, axis=1)>0
+    predictions = classes[classes.shape[0]-1-np.argmax(oobVotes[voted][:, ::-1], axis=1)]
+    return np.mean(predictions==y[voted])
+
+"""
+Returns the importance of each feature for the forest: the importances of the trees (see Node.expand) averaged with the weights of the trees.
+"""
+def randomForestFeatureImportances(randomForest):
+    importances = np.zeros(randomForest[0][0].featureImportances.shape[0])
     sum_weights = 0
-    sum_votes = np.zeros(X.shape[0])
-    for tree in randomForest:
-        this_tree = tree[0]
-        this_tree.printInfo()
-        this_weight = tree[1]
+    for this_tree, this_weight in randomForest:
+        importances += this_weight*this_tree.featureImportances
         sum_weights += this_weight
-        sum_votes += this_weight * this_tree.predict(X)
-    sum_votes = sum_votes/sum_weights
-    sum_votes[sum_votes>=0.5] = 1
-    sum_votes[sum_votes<0.5] = 0
-    return sum_votes
+    return importances/sum_weights
+
+"""
+All the trees of a forest compiled into one FlatTree (see Node.compile), the nodes of each tree being numbered after those of the previous ones.
+roots holds the number of the root of each tree and weights their weight in the vote. classes are the classes of the forest, None for a regression forest.
+The trees of a forest share the categories found when the data was encoded, so their category masks are laid end to end like the rest of their arrays and the data only has to be encoded once for the whole forest.
+"""
+class FlatForest:
+
+    def __init__(self, randomForest):
+        flatTrees = [tree[0].compile() for tree in randomForest]
+        featureTypes = flatTrees[0].featureTypes
+        categories = flatTrees[0].categories
+
+        roots = np.zeros(len(flatTrees), dtype=np.intp)
+        features, thresholds, lefts, rights, values, isCategoricals, categoryMasks = [], [], [], [], [], [], []
+        offset = 0
+        maskOffset = 0
+        for i, flatTree in enumerate(flatTrees):
+            roots[i] = offset
+            features.append(flatTree.feature)
+            thresholds.append(np.where(flatTree.isCategorical, flatTree.threshold+maskOffset, flatTree.threshold))
+            lefts.append(np.where(flatTree.left>=0, flatTree.left+offset, -1))
+            rights.append(np.where(flatTree.right>=0, flatTree.right+offset, -1))
+            values.append(flatTree.value)
+            isCategoricals.append(flatTree.isCategorical)
+            categoryMasks.append(flatTree.categoryMasks)
+            offset += flatTree.feature.shape[0]
+            maskOffset += flatTree.categoryMasks.shape[0]
+
+        self.tree = FlatTree(np.concatenate(features), np.concatenate(thresholds), np.concatenate(lefts).astype(np.int32), np.concatenate(rights).astype(np.int32), np.concatenate(values), np.concatenate(isCategoricals), featureTypes, categories, np.concatenate(categoryMasks))
+        self.roots = roots
+        self.weights = np.array([tree[1] for tree in randomForest], dtype=float)
+        self.classes = randomForest[0][0].classes
+
+    """
+    Builds a FlatForest from its arrays without compiling any tree, e.g. when loading a saved forest (see modelIO).
+    """
+    @classmethod
+    def fromArrays(cls, tree, roots, weights, classes):
+        flatForest = cls.__new__(cls)
+        flatForest.tree = tree
+        flatForest.roots = roots
+        flatForest.weights = weights
+        flatForest.classes = classes
+        return flatForest
+
+    """
+    Returns the weighted votes of the given trees for each class, for data that is already encoded. This is an array of shape (n_samples, n_classes).
+    For a regression forest, it is the weighted sum of the predictions of the trees, of shape (n_samples, 1).
+    Every (tree, row) pair is routed at once through the forest.
+    """
+    def votes(self, X, trees):
+        rows = np.tile(np.arange(X.shape[0], dtype=np.intp), trees.shape[0])
+        leaves = self.tree.route(X, rows, np.repeat(self.roots[trees], X.shape[0]))
+        weights = np.repeat(self.weights[trees], X.shape[0])
+        if self.classes is None:
+            return np.bincount(rows, weights=weights*self.tree.value[leaves], minlength=X.shape[0]).reshape(-1, 1)
+        classes = np.searchsorted(self.classes, self.tree.value[leaves])
+        return np.bincount(rows*self.classes.shape[0]+classes, weights=weights, minlength=X.shape[0]*self.classes.shape[0]).reshape(X.shape[0], self.classes.shape[0])
+
+    """
+    Returns the weighted class probabilities of every sample, as an array of shape (n_samples, n_classes) whose columns follow self.classes.
+    For a regression forest, the only column holds the weighted mean of the predictions of the trees.
+    The rows are processed chunk_size at a time, which keeps the memory bounded and the working arrays small enough to stay in cache. Within a chunk, the trees are split in n_jobs blocks evaluated by as many threads.
+    """
+    def predictProba(self, X, n_jobs=1, chunk_size=1024):
+        if n_jobs==-1:
+            n_jobs = os.cpu_count()
+        blocks = np.array_split(np.arange(self.roots.shape[0]), min(n_jobs, self.roots.shape[0]))
+        probabilities = np.zeros((X.shape[0], 1 if self.classes is None else self.classes.shape[0]))
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            for start in range(0, X.shape[0], chunk_size):
+                rows = slice(start, start+chunk_size)
+                chunk = self.tree.encode(X.take(rows) if isinstance(X, Dataset) else X[rows])
+                for votes in executor.map(lambda trees: self.votes(chunk, trees), blocks):
+                    probabilities[start:start+chunk.shape[0]] += votes
+        return probabilities/np.sum(self.weights)
+
+"""
+Predicts the class of every sample with a weighted vote of the trees of the forest, which can be given as returned by randomForest or already compiled into a FlatForest to be reused between calls.
+The predicted class is the one with the highest weighted vote, ties going to the highest class (so, for 0/1 labels, a sample is predicted as 1 as soon as half of the weights vote for it).
+With return_proba=True, the weighted class probabilities are returned as well (see FlatForest.predictProba).
+A regression forest predicts the weighted mean of the predictions of its trees.
+"""
+def randomForestPredict(randomForest, X, n_jobs=1, chunk_size=1024, return_proba=False):
+    if not isinstance(randomForest, FlatForest):
+        randomForest = FlatForest(randomForest)
+    probabilities = randomForest.predictProba(X, n_jobs=n_jobs, chunk_size=chunk_size)
+    if randomForest.classes is None:
+        return probabilities[:, 0]
+    votes = randomForest.classes[probabilities.shape[1]-1-np.argmax(probabilities[:, ::-1], axis=1)]
+    if return_proba:
+        return votes, probabilities
+    return votes
 
 if __name__=="__main__":
     """
     First, load the dataset and prepare the data by transforming quality in numerical data. 
     Also split the dataset in 66:33 for training:testing
     """
-    dataset = pd.read_csv("../misc/datasets/wine.csv")
-    for i in range(0, dataset.shape[0]):
-        if dataset.iloc[i,-1]=="good":
-            dataset.iloc[i,-1]=1
-        else:
-            dataset.iloc[i,-1]=0
-
-    X = np.asarray(dataset)[:, :-1]
-    y = np.asarray(dataset)[:, -1]
-    split = int(X.shape[0]*(66/100))
+    dataset = Dataset.fromDataFrame(pd.read_csv("../misc/datasets/wine.csv"), label="quality", labels={"good": 1, "bad": 0})
+    split = int(len(dataset)*(66/100))
 
-    X_train = X[:split]
-    y_train = y[:split]
-    X_test = X[split:]
-    y_test = y[split:]
+    X_train = dataset.take(slice(0, split))
+    y_train = X_train.y
+    X_test = dataset.take(slice(split, None))
+    y_test = X_test.y
 
     print(f"There are {X_train.shape[0]} data for training and {X_test.shape[0]} data for testing")
     print(f"There are {X_train.shape[1]} features in each")
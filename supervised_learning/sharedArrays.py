@@ -0,0 +1,76 @@
+import numpy as np
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+"""
+Helpers to share read-only numpy arrays with worker processes without pickling them for every task.
+shareArrays copies each array once into a shared memory block and returns descriptors (name, shape and dtype) that are cheap to send to the workers, which rebuild the arrays on top of the same memory with attachArrays.
+Object arrays (e.g. data holding strings) can't live in shared memory as they only hold pointers, so their descriptor is the array itself and they are pickled once per worker instead.
+None entries are kept as None so that optional arrays can be passed along.
+"""
+def shareArrays(arrays):
+    blocks = []
+    descriptors = []
+    for array in arrays:
+        if array is None or array.dtype==object:
+            descriptors.append(array)
+            continue
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        descriptors.append((block.name, array.shape, array.dtype.str))
+    return blocks, descriptors
+
+"""
+Rebuilds the arrays described by shareArrays. The shared memory blocks are returned along with the arrays as they must stay open for as long as the arrays are used.
+"""
+def attachArrays(descriptors):
+    blocks = []
+    arrays = []
+    for descriptor in descriptors:
+        if not isinstance(descriptor, tuple):
+            arrays.append(descriptor)
+            continue
+        name, shape, dtype = descriptor
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        arrays.append(np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf))
+    return blocks, arrays
+
+"""
+Frees the shared memory blocks created by shareArrays, once the workers are done with them.
+"""
+def releaseArrays(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+"""
+The shared arrays and the function of a worker process of runInPool, attached once when the worker starts.
+"""
+workerData = dict()
+
+def attachWorkerData(descriptors, function):
+    workerData["blocks"], workerData["arrays"] = attachArrays(descriptors)
+    workerData["function"] = function
+
+def runWorkerTask(task):
+    return workerData["function"](*workerData["arrays"], task)
+
+"""
+Returns [function(*arrays, task) for task in tasks], computed in the main process when n_jobs=1 or by a pool of n_jobs worker processes otherwise (n_jobs=-1 to use all the cores).
+The arrays are copied once into shared memory, which all the workers read from, instead of being sent with every task. function must be picklable, e.g. a function of a module or a functools.partial of one.
+"""
+def runInPool(arrays, function, tasks, n_jobs=1):
+    if n_jobs==-1:
+        n_jobs = os.cpu_count()
+    if n_jobs==1:
+        return [function(*arrays, task) for task in tasks]
+    blocks, descriptors = shareArrays(arrays)
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=attachWorkerData, initargs=(descriptors, function)) as executor:
+            return list(executor.map(runWorkerTask, tasks))
+    finally:
+        releaseArrays(blocks)